@@ -4,7 +4,11 @@ Day 1: Inverse Captcha
 
 '''
 
+import os
+import sys
+import tempfile
 import unittest
+import numpy
 
 # Part 1 tests and input
 
@@ -25,6 +29,14 @@ PART2_TESTS = [('1212', 6),
 
 PART2_INPUT = PART1_INPUT
 
+# Strings at least this long are handed to the vectorized engine
+
+VECTORIZED_THRESHOLD = 10000
+
+# Number of digits compared at a time when working from a memory-mapped file
+
+FILE_CHUNK_SIZE = 1 << 20
+
 # Solution
 
 def calculateCaptcha(integerString, offset=1):
@@ -32,6 +44,22 @@ def calculateCaptcha(integerString, offset=1):
     Calculates a 'CAPTCHA' checksum by summing integers in a sequence if the current integer matches
     another integer an <offset> distance away from the current integer.
 
+    Short strings use the reference implementation, long ones the vectorized NumPy engine.
+
+    Inputs are integerString, a string of integers, and an optional offset distance for the comparison.
+    Returns an integer sum based on the checksum algorithm.
+
+    '''
+
+    if len(integerString) >= VECTORIZED_THRESHOLD:
+        return calculateCaptchaVectorized(integerString, offset)
+
+    return calculateCaptchaReference(integerString, offset)
+
+def calculateCaptchaReference(integerString, offset=1):
+    '''
+    Reference implementation of the 'CAPTCHA' checksum, walking the sequence one integer at a time.
+
     Inputs are integerString, a string of integers, and an optional offset distance for the comparison.
     Returns an integer sum based on the checksum algorithm.
 
@@ -62,6 +90,179 @@ def calculateCaptcha(integerString, offset=1):
 
     return runningTotal
 
+def decodeDigits(integerString):
+    '''
+    Converts a string of digits to a NumPy uint8 array of digit values, without building
+    an intermediate list of Python integers.
+
+    Input is integerString, a string of integers. Returns a uint8 array.
+
+    '''
+
+    # Every digit is one ASCII byte, so the encoded string can be viewed as bytes directly
+    digits = numpy.frombuffer(integerString.encode('ascii'), dtype=numpy.uint8) - ord('0')
+
+    # Anything that wasn't a digit has wrapped around to a value above 9
+    if digits.size and digits.max() > 9:
+        raise ValueError('Captcha input must only contain digits')
+
+    return digits
+
+def calculateCaptchaVectorized(integerString, offset=1):
+    '''
+    Vectorized implementation of the 'CAPTCHA' checksum.
+
+    Instead of doubling the sequence, the digits are compared against a rolled view made up
+    of two slices: the tail of the sequence after <offset>, and the wrapped-around head.
+
+    Inputs are integerString, a string of integers, and an optional offset distance for the comparison.
+    Returns an integer sum based on the checksum algorithm.
+
+    '''
+
+    digits = decodeDigits(integerString)
+    nDigits = digits.size
+
+    if nDigits == 0:
+        return 0
+
+    offset %= nDigits
+    split = nDigits - offset
+
+    # digits[i] is compared with digits[i + offset], wrapping past the end of the sequence
+    runningTotal = numpy.sum(digits[:split], where=digits[:split] == digits[offset:], dtype=numpy.int64)
+    runningTotal += numpy.sum(digits[split:], where=digits[split:] == digits[:offset], dtype=numpy.int64)
+
+    return int(runningTotal)
+
+def findFastFFTLength(minimumLength):
+    '''
+    Returns the smallest length of at least minimumLength whose only prime factors are 2, 3 and 5.
+    NumPy's FFT is fast for these lengths, but lengths with large prime factors fall back on a
+    much slower algorithm.
+
+    '''
+
+    bestLength = 1 << max(minimumLength - 1, 0).bit_length()
+    power5 = 1
+
+    while power5 < bestLength:
+        power35 = power5
+        while power35 < bestLength:
+            # Make up the rest with the smallest power of two
+            length = power35 << max(-(-minimumLength // power35) - 1, 0).bit_length()
+            bestLength = min(bestLength, length)
+            power35 *= 3
+        power5 *= 5
+
+    return bestLength
+
+def calculateCaptchaSweep(integerString):
+    '''
+    Calculates the 'CAPTCHA' checksum for every offset from 0 to len(integerString)//2 at once.
+
+    The sum for an offset k is the sum over digit values d of d times the number of positions
+    where d matches d again k places later, which is the circular autocorrelation of the
+    indicator array for d. All ten autocorrelations are weighted and combined in frequency
+    space, so the whole sweep is a handful of FFTs: O(n log n) rather than O(n^2).
+
+    Input is integerString, a string of integers.
+    Returns an int64 NumPy array indexed by offset, so result[k] == calculateCaptcha(integerString, k).
+
+    '''
+
+    digits = decodeDigits(integerString)
+    nDigits = digits.size
+
+    if nDigits == 0:
+        return numpy.zeros(1, dtype=numpy.int64)
+
+    # If the length is already a fast FFT size, length n transforms give the circular
+    # correlation directly. Otherwise it's folded together from a linear one, zero-padded to a
+    # fast size, since lengths with large prime factors are several times slower.
+    if findFastFFTLength(nDigits) == nDigits:
+        fftLength = nDigits
+    else:
+        fftLength = findFastFFTLength(2 * nDigits - 1)
+
+    # Accumulate the weighted power spectrum of each digit's indicator array
+    # Zeroes never contribute to the sum, so they can be skipped
+    spectrum = numpy.zeros(fftLength // 2 + 1)
+
+    for digit in range(1, 10):
+        indicator = (digits == digit).astype(numpy.float64)
+        if not indicator.any():
+            continue
+        transform = numpy.fft.rfft(indicator, fftLength)
+        spectrum += digit * (transform.real ** 2 + transform.imag ** 2)
+
+    if fftLength == nDigits:
+        # The circular correlation is symmetric, so only the first half is needed
+        correlation = numpy.fft.irfft(spectrum, fftLength)[:nDigits // 2 + 1]
+    else:
+        linear = numpy.fft.irfft(spectrum, fftLength)
+
+        # Matches for offset k either don't wrap (lag k) or wrap around the end (lag n - k)
+        offsets = numpy.arange(nDigits // 2 + 1)
+        correlation = linear[offsets] + linear[(nDigits - offsets) % nDigits]
+        correlation[0] = linear[0]
+
+    return numpy.rint(correlation).astype(numpy.int64)
+
+def calculateCaptchaFromFile(fileName, offset=1, chunkSize=FILE_CHUNK_SIZE):
+    '''
+    Calculates the 'CAPTCHA' checksum of a file of digits without reading it into memory.
+
+    The file is memory-mapped and walked with two cursors, one at the current digit and one
+    <offset> digits ahead. The leading cursor wraps back to the start of the mapping instead of
+    the sequence being copied, and only one block of <chunkSize> digits per cursor is ever
+    decoded at a time, so memory use doesn't depend on the size of the file.
+
+    Inputs are fileName, the path to a file of digits (trailing whitespace is ignored), an
+    optional offset distance for the comparison (None for half the length of the sequence), and
+    an optional block size. Returns an integer sum based on the checksum algorithm.
+
+    '''
+
+    if os.path.getsize(fileName) == 0:
+        return 0
+
+    mapping = numpy.memmap(fileName, dtype=numpy.uint8, mode='r')
+    nDigits = mapping.size
+
+    # Ignore any trailing newline or other whitespace
+    while nDigits and mapping[nDigits - 1] in b' \t\r\n':
+        nDigits -= 1
+
+    if nDigits == 0:
+        return 0
+
+    if offset is None:
+        offset = nDigits // 2
+
+    offset %= nDigits
+
+    runningTotal = 0
+    current = 0
+
+    while current < nDigits:
+        ahead = (current + offset) % nDigits
+
+        # Stop the block at the end of the sequence for either cursor, so the next block
+        # picks up with the leading cursor wrapped back to the start
+        blockLength = min(chunkSize, nDigits - current, nDigits - ahead)
+
+        currentDigits = mapping[current:current + blockLength] - ord('0')
+        aheadDigits = mapping[ahead:ahead + blockLength] - ord('0')
+
+        if currentDigits.max() > 9:
+            raise ValueError('Captcha file {0} must only contain digits'.format(fileName))
+
+        runningTotal += int(numpy.sum(currentDigits, where=currentDigits == aheadDigits, dtype=numpy.int64))
+        current += blockLength
+
+    return runningTotal
+
 # Unit tests
 
 class TestCaptcha(unittest.TestCase):
@@ -92,8 +293,99 @@ class TestCaptcha(unittest.TestCase):
         for (testString, testResult) in PART2_TESTS:
             self.assertEqual(calculateCaptcha(testString, len(testString)//2), testResult)
 
+    # Vectorized engine against the reference implementation
+
+    def test_vectorized(self):
+        '''
+        Vectorized engine tests
+
+        '''
+
+        for (testString, testResult) in PART1_TESTS:
+            self.assertEqual(calculateCaptchaVectorized(testString), testResult)
+
+        for (testString, testResult) in PART2_TESTS:
+            self.assertEqual(calculateCaptchaVectorized(testString, len(testString)//2), testResult)
+
+        for offset in (1, 7, len(PART1_INPUT)//2, len(PART1_INPUT) - 1):
+            self.assertEqual(calculateCaptchaVectorized(PART1_INPUT, offset),
+                             calculateCaptchaReference(PART1_INPUT, offset))
+
+        self.assertRaises(ValueError, calculateCaptchaVectorized, '12a4')
+
+    # All offsets at once
+
+    def test_sweep(self):
+        '''
+        Offset sweep tests
+
+        '''
+
+        for (testString, testResult) in PART2_TESTS:
+            self.assertEqual(calculateCaptchaSweep(testString)[len(testString)//2], testResult)
+
+        sweep = calculateCaptchaSweep(PART1_INPUT)
+        self.assertEqual(len(sweep), len(PART1_INPUT)//2 + 1)
+
+        for offset in range(len(sweep)):
+            self.assertEqual(sweep[offset], calculateCaptchaVectorized(PART1_INPUT, offset))
+
+        # Lengths that are and aren't fast FFT sizes, padded or not
+        for nDigits in (1, 2, 3, 7, 16, 45, 97, 128, 1001, len(PART1_INPUT)):
+            testString = (PART1_INPUT * 2)[:nDigits]
+            sweep = calculateCaptchaSweep(testString)
+            self.assertEqual(sweep.tolist(), [calculateCaptchaVectorized(testString, offset) for offset in range(nDigits//2 + 1)])
+
+    def test_fast_length(self):
+        '''
+        Fast FFT length tests
+
+        '''
+
+        for (minimumLength, fastLength) in ((0, 1), (1, 1), (7, 8), (11, 12), (17, 18), (97, 100), (1001, 1024), (2000001, 2025000)):
+            self.assertEqual(findFastFFTLength(minimumLength), fastLength)
+
+        smoothLengths = sorted(2 ** a * 3 ** b * 5 ** c for a in range(12) for b in range(8) for c in range(6))
+
+        for minimumLength in range(1, 2049):
+            self.assertEqual(findFastFFTLength(minimumLength), min(length for length in smoothLengths if length >= minimumLength))
+
+    # Memory-mapped files
+
+    def test_file(self):
+        '''
+        Memory-mapped file tests
+
+        '''
+
+        with tempfile.TemporaryDirectory() as directory:
+            fileName = os.path.join(directory, 'captcha.txt')
+
+            for (testString, testResult) in PART1_TESTS:
+                with open(fileName, 'w') as digitFile:
+                    digitFile.write(testString + '\n')
+                self.assertEqual(calculateCaptchaFromFile(fileName), testResult)
+
+            for (testString, testResult) in PART2_TESTS:
+                with open(fileName, 'w') as digitFile:
+                    digitFile.write(testString)
+                self.assertEqual(calculateCaptchaFromFile(fileName, None, chunkSize=3), testResult)
+
+            with open(fileName, 'w') as digitFile:
+                digitFile.write(PART1_INPUT + '\n')
+
+            for offset in (1, 7, None):
+                expected = calculateCaptchaReference(PART1_INPUT, len(PART1_INPUT)//2 if offset is None else offset)
+                self.assertEqual(calculateCaptchaFromFile(fileName, offset, chunkSize=100), expected)
+
 if __name__ == '__main__':
 
     print('Advent of Code\nDay 1: Inverse Captcha\n')
-    print('Part 1: {0:d}'.format(calculateCaptcha(PART1_INPUT)))
-    print('Part 2: {0:d}'.format(calculateCaptcha(PART2_INPUT, len(PART2_INPUT)//2)))
+
+    # Optionally read the digits from a file instead of the built-in input
+    if len(sys.argv) > 1:
+        print('Part 1: {0:d}'.format(calculateCaptchaFromFile(sys.argv[1])))
+        print('Part 2: {0:d}'.format(calculateCaptchaFromFile(sys.argv[1], None)))
+    else:
+        print('Part 1: {0:d}'.format(calculateCaptcha(PART1_INPUT)))
+        print('Part 2: {0:d}'.format(calculateCaptcha(PART2_INPUT, len(PART2_INPUT)//2)))
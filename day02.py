@@ -4,7 +4,14 @@ Day 2: Corruption Checksum
 
 '''
 
+import io
+import os
+import sys
+import time
 import unittest
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy
 
 # Inputs and tests
 
@@ -38,6 +45,16 @@ PART1_INPUT_SPREADSHEET = '''104	240	147	246	123	175	372	71	116	230	260	118	202
 
 PART2_INPUT_SPREADSHEET = PART1_INPUT_SPREADSHEET
 
+# Streaming settings: characters read at a time, and rows sent to a worker at a time
+
+STREAM_CHUNK_SIZE = 1 << 22
+STREAM_BATCH_SIZE = 10000
+
+# Relative cost of a set lookup in the multiples search compared to a modulo in the pairwise search
+# (see benchmarkQuotientSearch)
+
+MULTIPLES_COST_FACTOR = 1.0
+
 # Solution
 
 def calculateRowChecksum1(rowString):
@@ -70,9 +87,59 @@ def calculateRowChecksum2(rowString):
     # Sort the list to put the smallest integers at the front
     integerList.sort()
 
+    # Pick whichever search should be cheaper for this row
+    if chooseQuotientSearch(integerList) == 'multiples':
+        quotient = findQuotientMultiples(integerList)
+    else:
+        quotient = findQuotientPairwise(integerList)
+
+    # assumes there will always be an answer!
+    if quotient is None:
+        raise RuntimeError('Unable to find solution for a row')
+
+    return quotient
+
+def chooseQuotientSearch(integerList):
+    '''
+    Chooses between the pairwise and multiples searches for a sorted row of integers.
+
+    The pairwise search costs about k^2 / 2 modulo operations for a row of k integers. The
+    multiples search costs about max // d set lookups for each candidate divisor d, so it wins
+    on wide rows unless the row has small values next to very large ones.
+
+    Returns 'pairwise' or 'multiples'.
+
+    '''
+
+    # The multiples search only makes sense for positive integers
+    if not integerList or integerList[0] <= 0:
+        return 'pairwise'
+
+    nIntegers = len(integerList)
+    pairwiseCost = nIntegers * (nIntegers - 1) // 2
+    maximum = integerList[-1]
+
+    # Add up the multiples cost, giving up as soon as it's clear pairwise is cheaper
+    multiplesCost = 0
+
+    for denominator in integerList:
+        multiplesCost += MULTIPLES_COST_FACTOR * (maximum // denominator)
+        if multiplesCost > pairwiseCost:
+            return 'pairwise'
+
+    return 'multiples'
+
+def findQuotientPairwise(integerList):
+    '''
+    Finds the quotient of the only two evenly divisible integers in a sorted list
+    by testing every pair. O(k^2) for a list of k integers.
+
+    Returns the integer quotient, or None if there's no such pair.
+
+    '''
+
     # work our way through the list until we find
     # the equally divisible ones
-    # assumes there will always be an answer!
 
     for (index, denominator) in enumerate(integerList):
         # now search through the rest to see if the current integer
@@ -86,7 +153,71 @@ def calculateRowChecksum2(rowString):
             if numerator % denominator == 0:
                 return numerator // denominator
 
-    raise RuntimeError('Unable to find solution for a row')
+    return None
+
+def findQuotientMultiples(integerList):
+    '''
+    Finds the quotient of the only two evenly divisible integers in a sorted list of positive
+    integers by looking up the multiples of each candidate denominator in a set of the row's values.
+    Costs about max // d lookups per denominator d, independent of the width of the row.
+
+    Returns the integer quotient, or None if there's no such pair. Finds the same pair as
+    findQuotientPairwise: smallest denominator first, then largest numerator.
+
+    '''
+
+    integerSet = set(integerList)
+    maximum = integerList[-1]
+    previous = None
+
+    for denominator in integerList:
+        # Only a repeated value can match itself, and that's handled below
+        if denominator == previous:
+            return 1
+        previous = denominator
+
+        # Step down through the multiples, largest first, stopping before the denominator itself
+        for numerator in range(maximum - maximum % denominator, denominator, -denominator):
+            if numerator in integerSet:
+                return numerator // denominator
+
+    return None
+
+def benchmarkQuotientSearch(width=1000, repeats=3):
+    '''
+    Times both quotient searches on rows of <width> - 2 small primes plus a much larger prime,
+    repeated so the only divisible pair is found last. The largest value is increased step by
+    step, which shows where the pairwise search becomes cheaper than the multiples search and
+    which one chooseQuotientSearch picks.
+
+    '''
+
+    # Primes never divide each other, so both searches have to try every denominator
+    smallPrimes = []
+    candidate = 2
+    while len(smallPrimes) < width - 2:
+        if all(candidate % prime for prime in smallPrimes if prime * prime <= candidate):
+            smallPrimes.append(candidate)
+        candidate += 1
+
+    print('Row width {0:d}'.format(width))
+    print('{0:>12s} {1:>14s} {2:>14s} {3:>10s}'.format('max', 'pairwise (s)', 'multiples (s)', 'chosen'))
+
+    for maximum in (10 ** 4, 10 ** 5, 3 * 10 ** 5, 10 ** 6, 3 * 10 ** 6, 10 ** 7):
+        # The next prime up from the target maximum, which none of the small primes divide
+        while maximum <= smallPrimes[-1] or any(maximum % prime == 0 for prime in range(2, int(maximum ** 0.5) + 1)):
+            maximum += 1
+
+        integerList = smallPrimes + [maximum, maximum]
+
+        timings = []
+        for search in (findQuotientPairwise, findQuotientMultiples):
+            startTime = time.perf_counter()
+            for _ in range(repeats):
+                search(integerList)
+            timings.append((time.perf_counter() - startTime) / repeats)
+
+        print('{0:12d} {1:14.4f} {2:14.4f} {3:>10s}'.format(maximum, timings[0], timings[1], chooseQuotientSearch(integerList)))
 
 CHECKSUM_ALGORITHMS = (calculateRowChecksum1, calculateRowChecksum2)
 
@@ -110,12 +241,67 @@ def calculateSpreadsheetChecksum(spreadsheetString, method=1):
     except IndexError:
         raise RuntimeError('Unknown checksum algorithm {0:d}'.format(method))
 
+    # Method 1 can be done for the whole spreadsheet at once
+    if method == 1:
+        return calculateMatrixChecksum1(loadSpreadsheetMatrix(spreadsheetString))
+
     # Step through each row in the input, keeping a tally of all the rows
     for row in convertToRows(spreadsheetString):
         total += calculateRowChecksum(row)
 
     return total
 
+def calculateMatrixChecksum1(matrix):
+    '''
+    Calculates the method 1 checksum for a whole spreadsheet matrix from loadSpreadsheetMatrix,
+    as the sum of the row-wise ranges.
+
+    Returns an integer checksum.
+
+    '''
+
+    if isinstance(matrix, numpy.ma.MaskedArray):
+        rowRanges = matrix.max(axis=1) - matrix.min(axis=1)
+    else:
+        rowRanges = numpy.ptp(matrix, axis=1)
+
+    return int(rowRanges.sum())
+
+def loadSpreadsheetMatrix(spreadsheetString):
+    '''
+    Parses the AoC spreadsheet format into a single 2-D NumPy integer array, one row per line.
+
+    If the rows have different lengths, the result is a masked array, padded on the right
+    with masked values. To checksum the same spreadsheet repeatedly without parsing it
+    again, load it once and pass the matrix to calculateMatrixChecksum1.
+
+    '''
+
+    values = []
+    rowLengths = []
+
+    # One pass through the rows, collecting the values and the length of each row
+    for row in convertToRows(spreadsheetString):
+        rowValues = row.split()
+        if rowValues:
+            values.extend(rowValues)
+            rowLengths.append(len(rowValues))
+
+    values = numpy.array(values, dtype=numpy.int64)
+    rowLengths = numpy.array(rowLengths, dtype=numpy.int64)
+    nColumns = int(rowLengths.max()) if rowLengths.size else 0
+
+    if numpy.all(rowLengths == nColumns):
+        matrix = values.reshape((rowLengths.size, nColumns))
+    else:
+        # Ragged rows: mask off the padding at the end of the short rows
+        mask = numpy.arange(nColumns) >= rowLengths[:, numpy.newaxis]
+        data = numpy.zeros(mask.shape, dtype=numpy.int64)
+        data[~mask] = values
+        matrix = numpy.ma.MaskedArray(data, mask=mask)
+
+    return matrix
+
 def convertToRows(fullArrayString):
     '''
     Converts the AoC input format to a list of rows (as strings).
@@ -124,6 +310,97 @@ def convertToRows(fullArrayString):
 
     return fullArrayString.strip().split('\n')
 
+def calculateBatchChecksum(rows, method=1):
+    '''
+    Calculates the checksum for a batch of rows, using the specified method.
+
+    Runs in a worker process for calculateStreamChecksum, so it must stay at module level.
+
+    Input is a list of row strings. Returns the integer sum of the row checksums.
+
+    '''
+
+    calculateRowChecksum = CHECKSUM_ALGORITHMS[method-1]
+
+    return sum(calculateRowChecksum(row) for row in rows)
+
+def readRowBatches(stream, batchSize=STREAM_BATCH_SIZE, chunkSize=STREAM_CHUNK_SIZE):
+    '''
+    Reads a spreadsheet from a text stream in large chunks and yields lists of up to
+    batchSize non-blank rows, so the whole spreadsheet is never held in memory.
+
+    '''
+
+    batch = []
+    remainder = ''
+
+    while True:
+        chunk = stream.read(chunkSize)
+
+        if not chunk:
+            break
+
+        # Hold on to the last, possibly partial, row until the next chunk arrives
+        lines = (remainder + chunk).split('\n')
+        remainder = lines.pop()
+
+        for line in lines:
+            if line.strip():
+                batch.append(line)
+                if len(batch) == batchSize:
+                    yield batch
+                    batch = []
+
+    if remainder.strip():
+        batch.append(remainder)
+
+    if batch:
+        yield batch
+
+def calculateStreamChecksum(stream, method=1, maxWorkers=None, batchSize=STREAM_BATCH_SIZE,
+                            chunkSize=STREAM_CHUNK_SIZE):
+    '''
+    Calculates a checksum for a spreadsheet read from a text stream, using the specified method.
+
+    Batches of rows are scored in a pool of worker processes. Only a couple of batches per
+    worker are in flight at any time, so memory use is bounded no matter how large the
+    spreadsheet is.
+
+    Input is a readable text stream (an open file or sys.stdin).
+    Returns a tuple of (checksum, number of rows, rows per second).
+
+    '''
+
+    if method not in range(1, len(CHECKSUM_ALGORITHMS) + 1):
+        raise RuntimeError('Unknown checksum algorithm {0:d}'.format(method))
+
+    total = 0
+    nRows = 0
+    startTime = time.perf_counter()
+
+    if maxWorkers is None:
+        maxWorkers = os.cpu_count() or 1
+
+    maxPending = 2 * maxWorkers
+    pending = deque()
+
+    with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+        for batch in readRowBatches(stream, batchSize, chunkSize):
+            # Wait on the oldest batch before reading any further ahead
+            if len(pending) == maxPending:
+                total += pending.popleft().result()
+
+            pending.append(executor.submit(calculateBatchChecksum, batch, method))
+            nRows += len(batch)
+
+        while pending:
+            total += pending.popleft().result()
+
+    elapsed = time.perf_counter() - startTime
+    rowsPerSecond = nRows / elapsed if elapsed > 0 else 0.0
+
+    return (total, nRows, rowsPerSecond)
+
 # Unit tests
 
 class TestChecksums(unittest.TestCase):
@@ -162,9 +439,91 @@ class TestChecksums(unittest.TestCase):
         # Test we get the right answer for the whole spreadsheet
         self.assertEqual(calculateSpreadsheetChecksum(PART2_TESTS[0][0], 2), PART2_TESTS[0][2])
 
+    # Whole-spreadsheet matrix
+
+    def test_matrix(self):
+        '''
+        Spreadsheet matrix tests
+
+        '''
+
+        matrix = loadSpreadsheetMatrix(PART1_TESTS[0][0])
+        self.assertTrue(isinstance(matrix, numpy.ma.MaskedArray))
+        self.assertEqual(matrix.shape, (3, 4))
+        self.assertEqual(calculateMatrixChecksum1(matrix), PART1_TESTS[0][2])
+
+        matrix = loadSpreadsheetMatrix(PART1_INPUT_SPREADSHEET)
+        self.assertEqual(matrix.shape, (16, 16))
+        self.assertEqual(calculateMatrixChecksum1(matrix),
+                         sum(calculateRowChecksum1(row) for row in convertToRows(PART1_INPUT_SPREADSHEET)))
+
+    # Quotient searches
+
+    def test_quotient_search(self):
+        '''
+        Pairwise and multiples search tests
+
+        '''
+
+        for row in convertToRows(PART2_TESTS[0][0]) + convertToRows(PART2_INPUT_SPREADSHEET) + ['3 7 7 11', '2 4 5 8']:
+            integerList = sorted(int(c) for c in row.split())
+            self.assertEqual(findQuotientMultiples(integerList), findQuotientPairwise(integerList))
+
+        self.assertIsNone(findQuotientMultiples([3, 5, 7]))
+        self.assertEqual(chooseQuotientSearch(list(range(1000, 2000))), 'multiples')
+        self.assertEqual(chooseQuotientSearch([2, 3, 10 ** 9]), 'pairwise')
+        self.assertEqual(chooseQuotientSearch([-1, 2, 3]), 'pairwise')
+
+    # Streaming
+
+    def test_stream(self):
+        '''
+        Streaming checksum tests
+
+        '''
+
+        for (spreadsheet, method, expected) in ((PART1_TESTS[0][0], 1, PART1_TESTS[0][2]),
+                                                (PART2_TESTS[0][0], 2, PART2_TESTS[0][2]),
+                                                (PART1_INPUT_SPREADSHEET, 1,
+                                                 calculateSpreadsheetChecksum(PART1_INPUT_SPREADSHEET, 1)),
+                                                (PART2_INPUT_SPREADSHEET, 2,
+                                                 calculateSpreadsheetChecksum(PART2_INPUT_SPREADSHEET, 2))):
+            stream = io.StringIO(spreadsheet + '\n')
+            (total, nRows, _) = calculateStreamChecksum(stream, method, maxWorkers=2, batchSize=2, chunkSize=7)
+            self.assertEqual(total, expected)
+            self.assertEqual(nRows, len(convertToRows(spreadsheet)))
+
 
 if __name__ == '__main__':
 
     print('Advent of Code\nDay 2: Corruption Checksum\n')
-    print('Part 1: {0:d}'.format(calculateSpreadsheetChecksum(PART1_INPUT_SPREADSHEET, 1)))
-    print('Part 2: {0:d}'.format(calculateSpreadsheetChecksum(PART2_INPUT_SPREADSHEET, 2)))
+
+    # Compare the row checksum 2 searches
+    if sys.argv[1:2] == ['--benchmark']:
+        for rowWidth in (100, 1000, 3000):
+            benchmarkQuotientSearch(rowWidth)
+        sys.exit()
+
+    # Optionally stream the spreadsheet from a file, or from stdin with '-', followed by
+    # an optional method. stdin can only be read once, so it defaults to method 1 only.
+    if len(sys.argv) > 1:
+        fileName = sys.argv[1]
+
+        if len(sys.argv) > 2:
+            methods = [int(sys.argv[2])]
+        elif fileName == '-':
+            methods = [1]
+        else:
+            methods = [1, 2]
+
+        for part in methods:
+            if fileName == '-':
+                result = calculateStreamChecksum(sys.stdin, part)
+            else:
+                with open(fileName) as inputStream:
+                    result = calculateStreamChecksum(inputStream, part)
+
+            print('Part {0:d}: {1:d} ({2:d} rows, {3:.0f} rows/sec)'.format(part, *result))
+    else:
+        print('Part 1: {0:d}'.format(calculateSpreadsheetChecksum(PART1_INPUT_SPREADSHEET, 1)))
+        print('Part 2: {0:d}'.format(calculateSpreadsheetChecksum(PART2_INPUT_SPREADSHEET, 2)))
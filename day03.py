@@ -4,6 +4,10 @@ Day 3: Spiral Memory
 
 '''
 
+import bisect
+import math
+import os
+import tempfile
 import unittest
 import numpy
 
@@ -124,21 +128,13 @@ def getLastFullRingSize(squareID):
         return 1
 
     # Find the biggest ring that doesn't contain the target square
+    # A full ring of size n (always odd) ends on square n ** 2, so that's the
+    # largest odd integer whose square is below the squareID
 
-    size = -1 # Need to start at zero, but sizes are odd, so
-    totalSquares = 1 # And, because we have a special exception for the first one, we need to count it
+    size = math.isqrt(squareID - 1)
 
-    while True:
-        size += 2
-        totalSquares += 4 * (size - 1)
-
-        # If squareID is bigger than then current number of squares
-        # and less than the current squares + the next layer
-        # then we've found the right ring
-
-        if squareID > totalSquares  and squareID <= totalSquares + 4 * (size + 1):
-            # found the right ring size
-            break
+    if size % 2 == 0:
+        size -= 1
 
     return size
 
@@ -259,6 +255,213 @@ def findNextAccumulation(target):
 
     return total
 
+def generateAccumulation():
+    '''
+    Generates the spiral accumulation sequence one value at a time, without end.
+
+    Only the squares filled so far are kept, in a dict keyed by (x, y), instead of a
+    matrix sized for the whole spiral.
+
+    '''
+
+    grid = {(0, 0): 1}
+    (x, y) = (0, 0)
+    (dx, dy) = (1, 0) # start off moving right
+
+    yield 1
+
+    while True:
+        x += dx
+        y += dy
+
+        total = sum(grid.get((x + i, y + j), 0) for i in (-1, 0, 1) for j in (-1, 0, 1))
+        grid[(x, y)] = total
+
+        yield total
+
+        # The spiral is counter-clockwise, so turn left whenever the square on the left is free
+        if (x - dy, y + dx) not in grid:
+            (dx, dy) = (-dy, dx)
+
+class AccumulationTable(object):
+    '''
+    Memoized prefix of the spiral accumulation sequence.
+
+    Values are only generated as far as the largest target asked for so far, so looking up
+    a target that's already covered is a binary search. The table can be saved to and
+    loaded from a file of one value per line.
+
+    '''
+    def __init__(self, values=None):
+        '''
+        'values' is an optional, previously computed prefix of the sequence.
+
+        '''
+        self.values = list(values) if values else []
+        self._generator = None
+
+    def extendPast(self, target):
+        '''
+        Generates values until the table holds one larger than target.
+
+        '''
+        if self.values and self.values[-1] > target:
+            return
+
+        # Start a generator, catching it up with any values that were loaded rather than generated
+        if self._generator is None:
+            self._generator = generateAccumulation()
+            for _ in range(len(self.values)):
+                next(self._generator)
+
+        while not self.values or self.values[-1] <= target:
+            self.values.append(next(self._generator))
+
+    def findNext(self, target):
+        '''
+        Finds the smallest value larger than target in the accumulation sequence.
+
+        '''
+        self.extendPast(target)
+
+        return self.values[bisect.bisect_right(self.values, target)]
+
+    def save(self, fileName):
+        '''
+        Writes the table to a file, one value per line.
+
+        '''
+        with open(fileName, 'w') as tableFile:
+            tableFile.write('\n'.join(str(value) for value in self.values))
+
+    @classmethod
+    def load(cls, fileName):
+        '''
+        Reads a table previously written by save. A missing file gives an empty table.
+
+        '''
+        if not os.path.exists(fileName):
+            return cls()
+
+        with open(fileName) as tableFile:
+            return cls(int(line) for line in tableFile if line.strip())
+
+def findCoordinatesBatch(squareIDs):
+    '''
+    Finds the x,y coordinates of many squareIDs at once.
+
+    Same arithmetic as findCoordinates, but with the ring found in closed form and the march
+    around the ring done as a selection between the four sides.
+
+    Input is an array-like of integer squareIDs, output is a tuple of two integer
+    NumPy arrays (x, y) with the same shape.
+
+    '''
+
+    squareIDs = numpy.asarray(squareIDs, dtype=numpy.int64)
+
+    # Size of the last full ring: the largest odd integer whose square is below the squareID
+    # Correct the floating point square root in case it's out by one for large IDs
+    offsetIDs = numpy.maximum(squareIDs - 1, 0)
+    size = numpy.floor(numpy.sqrt(offsetIDs)).astype(numpy.int64)
+    size -= size * size > offsetIDs
+    size += (size + 1) * (size + 1) <= offsetIDs
+    size -= size % 2 == 0
+
+    distanceFromRingStart = squareIDs - (size ** 2 + 1)
+
+    # now we need to find the location of the target in the next ring
+    size += 2
+    half = (size - 1) // 2
+
+    # The four sides of the ring: up, left, down and right, starting from (half, 1 - half)
+    up = distanceFromRingStart
+    left = distanceFromRingStart - (size - 2)
+    down = left - (size - 1)
+    right = down - (size - 1)
+
+    sides = [up <= (size - 2), left <= (size - 1), down <= (size - 1)]
+
+    x = numpy.select(sides, [half, half - left, -half], -half + right)
+    y = numpy.select(sides, [1 - half + up, half, half - down], -half)
+
+    # Square 1 is the exception again, at the origin
+    isOrigin = squareIDs == 1
+    x = numpy.where(isOrigin, 0, x)
+    y = numpy.where(isOrigin, 0, y)
+
+    return (x, y)
+
+def findSquareID(x, y):
+    '''
+    Finds the squareID at a particular pair of x,y coordinates, the inverse of findCoordinates.
+
+    Inputs are the integer coordinates, output is the integer squareID.
+
+    '''
+
+    # The ring holding (x, y) is the one max(|x|, |y|) out from the origin
+    half = max(abs(x), abs(y))
+
+    if half == 0:
+        return 1
+
+    size = 2 * half + 1
+    currentRingStartID = (size - 2) ** 2 + 1
+
+    # Find the distance along the ring, which starts at (half, 1 - half) and
+    # goes up, left, down and right
+    if x == half and y > -half:
+        distanceFromRingStart = y - (1 - half)
+    elif y == half:
+        distanceFromRingStart = (size - 2) + (half - x)
+    elif x == -half:
+        distanceFromRingStart = (size - 2) + (size - 1) + (half - y)
+    else:
+        distanceFromRingStart = (size - 2) + 2 * (size - 1) + (x + half)
+
+    return currentRingStartID + distanceFromRingStart
+
+def findSquareIDBatch(x, y):
+    '''
+    Finds the squareIDs at many x,y coordinates at once, the inverse of findCoordinatesBatch.
+
+    Inputs are array-likes of integer coordinates, broadcast against each other, so a whole
+    window can be labelled with a row of x values and a column of y values.
+    Output is an integer NumPy array of squareIDs.
+
+    '''
+
+    x = numpy.asarray(x, dtype=numpy.int64)
+    y = numpy.asarray(y, dtype=numpy.int64)
+
+    half = numpy.maximum(numpy.abs(x), numpy.abs(y))
+    size = 2 * half + 1
+
+    sides = [(x == half) & (y > -half), y == half, x == -half]
+    distanceFromRingStart = numpy.select(sides,
+                                         [y - (1 - half),
+                                          (size - 2) + (half - x),
+                                          (size - 2) + (size - 1) + (half - y)],
+                                         (size - 2) + 2 * (size - 1) + (x + half))
+
+    # The origin drops out as (-1) ** 2 + 1 + 0 = 2, so it needs its own exception
+    return numpy.where(half == 0, 1, (size - 2) ** 2 + 1 + distanceFromRingStart)
+
+def findManhattanDistanceBatch(starts, ends):
+    '''
+    Finds the 'Manhattan Distance' between many pairs of squares on the spiral at once.
+
+    Inputs are array-likes of integer square IDs (broadcast against each other), output
+    is an integer NumPy array of distances.
+
+    '''
+
+    (startX, startY) = findCoordinatesBatch(starts)
+    (endX, endY) = findCoordinatesBatch(ends)
+
+    return numpy.abs(startX - endX) + numpy.abs(startY - endY)
+
 # Unit tests
 
 class TestDistance(unittest.TestCase):
@@ -283,6 +486,27 @@ class TestDistance(unittest.TestCase):
         for (end, distance) in PART1_TESTS:
             self.assertEqual(findManhattanDistance(1, end), distance)
 
+    # Batches
+
+    def test_batch(self):
+        '''
+        Batch coordinate and distance tests
+
+        '''
+
+        squareIDs = numpy.arange(1, 5000)
+        (x, y) = findCoordinatesBatch(squareIDs)
+
+        for squareID in squareIDs:
+            self.assertEqual((x[squareID - 1], y[squareID - 1]), findCoordinates(int(squareID)))
+
+        ends = numpy.array([end for (end, distance) in PART1_TESTS])
+        distances = [distance for (end, distance) in PART1_TESTS]
+        self.assertEqual(list(findManhattanDistanceBatch(1, ends)), distances)
+
+        bigID = 10 ** 15 + 12345
+        self.assertEqual(tuple(int(c[0]) for c in findCoordinatesBatch([bigID])), findCoordinates(bigID))
+
     # Part 2
 
     def test_part2(self):
@@ -298,6 +522,56 @@ class TestDistance(unittest.TestCase):
         for (target, nextResult) in PART2_TESTS:
             self.assertEqual(findNextAccumulation(target), nextResult)
 
+    # Coordinates to squareIDs
+
+    def test_square_id(self):
+        '''
+        Inverse lookup tests
+
+        '''
+
+        squareIDs = numpy.arange(1, 20000)
+        (x, y) = findCoordinatesBatch(squareIDs)
+
+        self.assertTrue(numpy.array_equal(findSquareIDBatch(x, y), squareIDs))
+
+        for squareID in range(1, 2000):
+            self.assertEqual(findSquareID(*findCoordinates(squareID)), squareID)
+
+        window = findSquareIDBatch(numpy.arange(-2, 3)[numpy.newaxis, :], numpy.arange(2, -3, -1)[:, numpy.newaxis])
+        self.assertEqual(window.tolist(), [[17, 16, 15, 14, 13],
+                                           [18, 5, 4, 3, 12],
+                                           [19, 6, 1, 2, 11],
+                                           [20, 7, 8, 9, 10],
+                                           [21, 22, 23, 24, 25]])
+
+    # Accumulation generator and table
+
+    def test_accumulation_table(self):
+        '''
+        Accumulation generator and table tests
+
+        '''
+
+        generator = generateAccumulation()
+        self.assertEqual([next(generator) for _ in range(12)], [1, 1, 2, 4, 5, 10, 11, 23, 25, 26, 54, 57])
+
+        table = AccumulationTable()
+
+        for (target, nextResult) in PART2_TESTS:
+            self.assertEqual(table.findNext(target), nextResult)
+
+        self.assertEqual(table.findNext(PART2_TARGET), findNextAccumulation(PART2_TARGET))
+
+        with tempfile.TemporaryDirectory() as directory:
+            fileName = os.path.join(directory, 'accumulation.txt')
+            table.save(fileName)
+
+            loadedTable = AccumulationTable.load(fileName)
+            self.assertEqual(loadedTable.values, table.values)
+            self.assertEqual(loadedTable.findNext(10 ** 12), AccumulationTable().findNext(10 ** 12))
+            self.assertEqual(AccumulationTable.load(os.path.join(directory, 'missing.txt')).values, [])
+
 if __name__ == '__main__':
 
     print('Advent of Code\nDay 3: Spiral Memory\n')
@@ -4,7 +4,15 @@ Day 4: High-Entropy Passphrases
 
 '''
 
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import time
 import unittest
+from concurrent.futures import ProcessPoolExecutor
 
 # Inputs and tests
 
@@ -12,7 +20,7 @@ PART1_TESTS = [('aa bb cc dd ee', True),
                ('aa bb cc dd aa', False),
                ('aa bb cc dd aaa', True)]
 
-PART1_LINES = open('day04-input.txt').readlines()
+INPUT_FILE = 'day04-input.txt'
 
 PART2_TESTS = [('abcde fghij', True),
                ('abcde xyz ecdab', False),
@@ -20,8 +28,6 @@ PART2_TESTS = [('abcde fghij', True),
                ('iiii oiii ooii oooi oooo', True),
                ('oiii ioii iioi iiio', False)]
 
-PART2_LINES = PART1_LINES
-
 # Solution
 
 def evaluatePassPhrase1(passPhrase):
@@ -51,27 +57,33 @@ def evaluatePassPhrase1(passPhrase):
 
 # Part 2. No anagrams
 
+def anagramSignature(word):
+    '''
+    Returns a canonical signature for a word that's the same for all of its anagrams:
+    its letters in sorted order.
+
+    '''
+
+    return ''.join(sorted(word))
+
 class Word(object):
     '''
     Class for passphrase words that keeps track of the letters in the words and provides
     a comparison that looks at the letters and their frequency but doesn't care about
-    their order. The net result is that anagrams compare True.
+    their order. The net result is that anagrams compare True, and hash the same.
 
     '''
+    __slots__ = ('_originalWord', '_signature')
+
     def __init__(self, word):
         '''
         'word' must be a string.
 
         '''
         self._originalWord = word
-        self._letters = {}
 
-        # take the letters in the source word, and count the frequency of letters in the word
-        for letter in word:
-            if letter in self._letters:
-                self._letters[letter] += 1
-            else:
-                self._letters[letter] = 1
+        # the sorted letters capture both which letters are in the word and their frequency
+        self._signature = anagramSignature(word)
 
     def __eq__(self, other):
         '''
@@ -82,21 +94,15 @@ class Word(object):
         if not isinstance(other, Word):
             return False
 
-        # Grab the list of letters in the other Word
-        otherLetters = other._letters.keys()
-
-        # If the set of letters don't match,  it's a False comparison
-        if set(otherLetters) != set(self._letters.keys()):
-            return False
+        # Anagrams have the same letters with the same frequency, so the same signature
+        return self._signature == other._signature
 
-        # Check the frequency of occurence of letters. If the counts
-        # don't match, it's a False comparison
-        for letter in otherLetters:
-            if self._letters[letter] != other._letters[letter]:
-                return False
+    def __hash__(self):
+        '''
+        Anagrams hash the same, so Words can go in sets and dicts.
 
-        # That's all the conditions. If we're here, it's a match!
-        return True
+        '''
+        return hash(self._signature)
 
 def evaluatePassPhrase2(passPhrase):
     '''
@@ -107,19 +113,274 @@ def evaluatePassPhrase2(passPhrase):
 
     '''
 
-    # Split out the words from the phrase
-    words = [Word(word) for word in passPhrase.split()]
+    # Keep a set of the signatures of all the words in the passphrase
+    signatures = set()
 
-    # check each word against the others
-    # If we encounter one anagram, it's a False passphrase
-    for (index, word) in enumerate(words):
-        for other in words[index+1:]:
-            if word == other:
-                return False
+    # If a word's signature has been seen before, it's an anagram of an earlier
+    # word, and it's a False passphrase
+    for word in passPhrase.split():
+        signature = anagramSignature(word)
+        if signature in signatures:
+            return False
+        signatures.add(signature)
 
     # If we get here, it's a valid passphrase
     return True
 
+# Validating whole files
+
+def findChunkBoundaries(fileName, nChunks):
+    '''
+    Splits a file into roughly equal chunks that start and end on line boundaries.
+
+    Returns a list of (start, end) byte offsets.
+
+    '''
+
+    fileSize = os.path.getsize(fileName)
+
+    if fileSize == 0:
+        return []
+
+    with open(fileName, 'rb') as inputFile, mmap.mmap(inputFile.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+        boundaries = [0]
+
+        # move each evenly spaced split point forward to just after the next newline
+        for counter in range(1, nChunks):
+            newline = mapping.find(b'\n', max(counter * fileSize // nChunks, boundaries[-1]))
+            if newline == -1:
+                break
+            boundaries.append(newline + 1)
+
+    boundaries.append(fileSize)
+
+    return [(start, end) for (start, end) in zip(boundaries, boundaries[1:]) if end > start]
+
+def validateChunk(fileName, start, end):
+    '''
+    Checks every passphrase in a chunk of a file against both policies, in the same pass.
+
+    Runs in a worker process for validatePassPhraseFile, so it must stay at module level.
+
+    Returns a tuple of (valid with method 1, valid with method 2, number of lines).
+
+    '''
+
+    validCount1 = 0
+    validCount2 = 0
+    nLines = 0
+
+    with open(fileName, 'rb') as inputFile, mmap.mmap(inputFile.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+        mapping.seek(start)
+
+        while mapping.tell() < end:
+            line = mapping.readline().decode()
+            nLines += 1
+
+            if evaluatePassPhrase1(line):
+                validCount1 += 1
+            if evaluatePassPhrase2(line):
+                validCount2 += 1
+
+    return (validCount1, validCount2, nLines)
+
+def validatePassPhraseFile(fileName, maxWorkers=None, chunksPerWorker=4):
+    '''
+    Counts the valid passphrases in a file, one per line, using both policies.
+
+    The file is memory-mapped and split into line-aligned chunks, which are checked in a
+    pool of worker processes.
+
+    Returns a tuple of (valid with method 1, valid with method 2, number of lines, lines per second).
+
+    '''
+
+    if maxWorkers is None:
+        maxWorkers = os.cpu_count() or 1
+
+    validCount1 = 0
+    validCount2 = 0
+    nLines = 0
+    startTime = time.perf_counter()
+
+    chunks = findChunkBoundaries(fileName, maxWorkers * chunksPerWorker)
+
+    with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+        futures = [executor.submit(validateChunk, fileName, start, end) for (start, end) in chunks]
+
+        for future in futures:
+            (chunkValid1, chunkValid2, chunkLines) = future.result()
+            validCount1 += chunkValid1
+            validCount2 += chunkValid2
+            nLines += chunkLines
+
+    elapsed = time.perf_counter() - startTime
+    linesPerSecond = nLines / elapsed if elapsed > 0 else 0.0
+
+    return (validCount1, validCount2, nLines, linesPerSecond)
+
+# Repeats across files
+
+class BloomFilter(object):
+    '''
+    A Bloom filter stored in a memory-mapped file, for remembering which keys (bytes) have been
+    seen across many runs without keeping them all in memory. Membership tests can give
+    false positives, at roughly the rate the filter was created with, but never false negatives.
+
+    The file holds a small header with the filter parameters, followed by the bit array, so an
+    existing filter can be reopened and added to without being rebuilt.
+
+    '''
+    _HEADER = struct.Struct('<8sQQQ') # magic, number of bits, number of hashes, number of items
+    _MAGIC = b'AOCBLOOM'
+
+    def __init__(self, fileName, capacity=1000000, falsePositiveRate=0.001):
+        '''
+        Opens the filter in 'fileName', creating it if it doesn't exist yet.
+
+        A new filter is sized to hold 'capacity' keys with the given false positive rate.
+        For an existing filter, both are ignored in favour of the parameters in the file.
+
+        '''
+        self.fileName = fileName
+
+        if not os.path.exists(fileName):
+            if capacity <= 0 or not 0 < falsePositiveRate < 1:
+                raise ValueError('Bloom filter needs a positive capacity and a false positive rate between 0 and 1')
+
+            # Standard optimal sizes for the bit array and the number of hashes
+            nBits = max(8, int(math.ceil(-capacity * math.log(falsePositiveRate) / math.log(2) ** 2)))
+            nHashes = max(1, int(round(nBits / capacity * math.log(2))))
+
+            with open(fileName, 'wb') as filterFile:
+                filterFile.write(self._HEADER.pack(self._MAGIC, nBits, nHashes, 0))
+                filterFile.truncate(self._HEADER.size + (nBits + 7) // 8)
+
+        self._file = open(fileName, 'r+b')
+        self._mapping = mmap.mmap(self._file.fileno(), 0)
+
+        (magic, self.nBits, self.nHashes, self.nItems) = self._HEADER.unpack_from(self._mapping)
+
+        if magic != self._MAGIC:
+            self._mapping.close()
+            self._file.close()
+            raise ValueError('{0} is not a Bloom filter file'.format(fileName))
+
+    def _bitPositions(self, key):
+        '''
+        Returns the positions of the bits for a key, using double hashing of a stable digest.
+
+        '''
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        hash1 = int.from_bytes(digest[:8], 'little')
+        hash2 = int.from_bytes(digest[8:], 'little') | 1
+
+        return [(hash1 + counter * hash2) % self.nBits for counter in range(self.nHashes)]
+
+    def add(self, key):
+        '''
+        Adds a key to the filter. Returns True if the key was (probably) already there.
+
+        '''
+        offset = self._HEADER.size
+        mapping = self._mapping
+        alreadyPresent = True
+
+        for position in self._bitPositions(key):
+            byteIndex = offset + (position >> 3)
+            bit = 1 << (position & 7)
+            if not mapping[byteIndex] & bit:
+                alreadyPresent = False
+                mapping[byteIndex] |= bit
+
+        if not alreadyPresent:
+            self.nItems += 1
+
+        return alreadyPresent
+
+    def __contains__(self, key):
+        '''
+        True if the key is (probably) in the filter, False if it definitely isn't.
+
+        '''
+        offset = self._HEADER.size
+        mapping = self._mapping
+
+        return all(mapping[offset + (position >> 3)] & (1 << (position & 7)) for position in self._bitPositions(key))
+
+    def addMany(self, keys):
+        '''
+        Adds many keys to the filter. Returns a list of booleans, True for each key that
+        was (probably) already there, including repeats within 'keys'.
+
+        '''
+        return [self.add(key) for key in keys]
+
+    def containsMany(self, keys):
+        '''
+        Checks many keys against the filter. Returns a list of booleans.
+
+        '''
+        return [key in self for key in keys]
+
+    def flush(self):
+        '''
+        Writes the item count and the bit array back to the file.
+
+        '''
+        self._HEADER.pack_into(self._mapping, 0, self._MAGIC, self.nBits, self.nHashes, self.nItems)
+        self._mapping.flush()
+
+    def close(self):
+        '''
+        Flushes and closes the filter file.
+
+        '''
+        if not self._mapping.closed:
+            self.flush()
+            self._mapping.close()
+        self._file.close()
+
+    def __enter__(self):
+        '''
+        Allows the filter to be used in a with statement, closing it at the end.
+
+        '''
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def passPhraseKeys(passPhrase):
+    '''
+    Returns the Bloom filter keys for a passphrase: one for the phrase itself (its words in
+    order), and one for its anagram signature (the signatures of its words, sorted), so a phrase
+    made of anagrams of an earlier phrase's words, in any order, is caught too.
+
+    '''
+
+    words = passPhrase.split()
+
+    return (b'P:' + ' '.join(words).encode(),
+            b'A:' + ' '.join(sorted(anagramSignature(word) for word in words)).encode())
+
+def findRepeatedPassPhrases(bloomFilter, passPhrases):
+    '''
+    Checks passphrases against a BloomFilter of earlier passphrases, adding them as it goes.
+
+    Returns a list of (phrase repeated, anagram signature repeated) tuples, one per passphrase.
+    Either can be a false positive, at the filter's false positive rate.
+
+    '''
+
+    repeats = []
+
+    for passPhrase in passPhrases:
+        (phraseKey, anagramKey) = passPhraseKeys(passPhrase)
+        repeats.append((bloomFilter.add(phraseKey), bloomFilter.add(anagramKey)))
+
+    return repeats
+
 # Unit tests
 
 class TestPassPhrase(unittest.TestCase):
@@ -148,26 +409,84 @@ class TestPassPhrase(unittest.TestCase):
         for (passPhrase, validity) in PART2_TESTS:
             self.assertEqual(evaluatePassPhrase2(passPhrase), validity)
 
-if __name__ == '__main__':
+    def test_file(self):
+        '''
+        Whole file tests
 
-    print('Advent of Code\nDay 4: High-Entropy Passphrases\n')
+        '''
+
+        with tempfile.TemporaryDirectory() as directory:
+            fileName = os.path.join(directory, 'passphrases.txt')
+
+            with open(fileName, 'w') as passPhraseFile:
+                passPhraseFile.write('\n'.join(passPhrase for (passPhrase, validity) in PART1_TESTS + PART2_TESTS))
+
+            expected = (sum(evaluatePassPhrase1(passPhrase) for (passPhrase, validity) in PART1_TESTS + PART2_TESTS),
+                        sum(evaluatePassPhrase2(passPhrase) for (passPhrase, validity) in PART1_TESTS + PART2_TESTS),
+                        len(PART1_TESTS + PART2_TESTS))
+
+            for nChunks in (1, 3, 100):
+                chunks = findChunkBoundaries(fileName, nChunks)
+                self.assertEqual(chunks[0][0], 0)
+                self.assertEqual(chunks[-1][1], os.path.getsize(fileName))
 
-    # Loop over all the input lines, count the valid passphrases using method 1
-    validPassphraseCount = 0
+                counts = [validateChunk(fileName, start, end) for (start, end) in chunks]
+                self.assertEqual(tuple(sum(count) for count in zip(*counts)), expected)
 
-    for line in PART1_LINES:
-        result = evaluatePassPhrase1(line)
-        if result:
-            validPassphraseCount += 1
+            self.assertEqual(validatePassPhraseFile(fileName, maxWorkers=2)[:3], expected)
 
-    print('Part 1: {0:d} valid passphrases'.format(validPassphraseCount))
+    def test_bloom_filter(self):
+        '''
+        Bloom filter index tests
+
+        '''
+
+        with tempfile.TemporaryDirectory() as directory:
+            fileName = os.path.join(directory, 'passphrases.bloom')
+
+            with BloomFilter(fileName, capacity=1000, falsePositiveRate=0.01) as bloomFilter:
+                self.assertEqual(bloomFilter.addMany([b'a', b'b', b'a']), [False, False, True])
+                self.assertEqual(findRepeatedPassPhrases(bloomFilter, ['abcde fghij', 'abcde  fghij', 'edcba fghij']),
+                                 [(False, False), (True, True), (False, True)])
+
+                # Anagrams of the words in a different order
+                self.assertEqual(findRepeatedPassPhrases(bloomFilter, ['abc def', 'fed cba', 'def abc']),
+                                 [(False, False), (False, True), (False, True)])
+
+                keys = [str(i).encode() for i in range(1000)]
+                bloomFilter.addMany(keys)
+                nItems = bloomFilter.nItems
+
+            # Reopening keeps the contents and parameters
+            with BloomFilter(fileName, capacity=1) as bloomFilter:
+                self.assertEqual(bloomFilter.nItems, nItems)
+                self.assertTrue(all(bloomFilter.containsMany(keys)))
+
+                falsePositives = sum(bloomFilter.containsMany(str(-i).encode() for i in range(1, 10001)))
+                self.assertLess(falsePositives, 300)
 
-    # Loop over all the input lines, count the valid passphrases using method 2
-    validPassphraseCount = 0
+            with open(fileName, 'r+b') as filterFile:
+                filterFile.write(b'NOTBLOOM')
+            self.assertRaises(ValueError, BloomFilter, fileName)
+
+    def test_words(self):
+        '''
+        Word comparison and hashing tests
+
+        '''
+
+        self.assertEqual(Word('abcde'), Word('ecdab'))
+        self.assertNotEqual(Word('abcde'), Word('abcdd'))
+        self.assertNotEqual(Word('abc'), 'abc')
+        self.assertEqual(len({Word('oiii'), Word('ioii'), Word('iioi'), Word('ooii')}), 2)
+
+if __name__ == '__main__':
+
+    print('Advent of Code\nDay 4: High-Entropy Passphrases\n')
 
-    for line in PART2_LINES:
-        result = evaluatePassPhrase2(line)
-        if result:
-            validPassphraseCount += 1
+    # Check every line against both policies in one pass over the file
+    (validCount1, validCount2, lineCount, rate) = validatePassPhraseFile(INPUT_FILE)
 
-    print('Part 2: {0:d} valid passphrases'.format(validPassphraseCount))
+    print('Part 1: {0:d} valid passphrases'.format(validCount1))
+    print('Part 2: {0:d} valid passphrases'.format(validCount2))
+    print('({0:d} passphrases, {1:.0f} passphrases/sec)'.format(lineCount, rate))
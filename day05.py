@@ -4,10 +4,33 @@ Day 5: A Maze of Twisty Trampolines, All Alike
 
 '''
 
+import os
+import random
+import struct
+import tempfile
+import time
 import unittest
+from array import array
+import numpy
 
 TEST_INSTRUCTIONS = ['0', '3', '0', '1', '-3']
-INPUT_INSTRUCTIONS = open('day05-input.txt').readlines()
+INPUT_FILE = 'day05-input.txt'
+
+# Binary int32 copies of parsed instruction files are cached next to them with this suffix
+
+CACHE_SUFFIX = '.int32'
+
+# Each cache starts with the size and modification time of the text it was parsed from,
+# and is only used while they match the text file exactly
+
+CACHE_HEADER = struct.Struct('<8sqq') # magic, source size, source mtime in ns
+CACHE_MAGIC = b'AOCJMP32'
+
+# Method 2 settles offsets into alternating 2s and 3s behind the cursor. Runs of settled
+# offsets are packed into blocks of bits (0 for a 2, 1 for a 3), and crossed a block at a time.
+
+BLOCK_BITS = 16
+BLOCK_MASK = BLOCK_BITS - 1
 
 def followInstructions(instructionString, method=1):
     '''
@@ -54,6 +77,349 @@ def followInstructions(instructionString, method=1):
 
     return counter
 
+def buildBlockTables():
+    '''
+    Builds the lookup tables for crossing a block of settled offsets in one go.
+
+    For every block state (BLOCK_BITS offsets of 2 or 3, packed as bits) and every entry
+    position in the block, the tables hold the block state after the cursor has jumped out of
+    it, the number of jumps taken and the exit position in the next block. They're indexed
+    by (state << log2(BLOCK_BITS)) | position.
+
+    '''
+
+    nStates = 1 << BLOCK_BITS
+
+    states = numpy.repeat(numpy.arange(nStates, dtype=numpy.int64), BLOCK_BITS)
+    positions = numpy.tile(numpy.arange(BLOCK_BITS, dtype=numpy.int64), nStates)
+    steps = numpy.zeros(states.size, dtype=numpy.int64)
+
+    # Walk all the blocks at once until every cursor has left its block
+    inBlock = positions < BLOCK_BITS
+
+    while inBlock.any():
+        bits = (states >> numpy.minimum(positions, BLOCK_MASK)) & 1
+
+        # A 2 jumps 2 and becomes a 3, a 3 jumps 3 and becomes a 2
+        states = numpy.where(inBlock, states ^ (1 << numpy.minimum(positions, BLOCK_MASK)), states)
+        steps += inBlock
+        positions = numpy.where(inBlock, positions + 2 + bits, positions)
+        inBlock = positions < BLOCK_BITS
+
+    return (states.tolist(), steps.tolist(), (positions - BLOCK_BITS).tolist())
+
+BLOCK_TABLES = None
+
+def followInstructionsFast(instructionString, method=1):
+    '''
+    Faster version of followInstructions, giving exactly the same count of jumps.
+
+    The instructions are kept in a compact array('i'). For method 2, the prefix of the list
+    that has settled into 2s and 3s is packed into blocks of bits, and the cursor crosses
+    whole blocks through a lookup table instead of one jump at a time.
+
+    Input is a list of string integer instructions. Output is the count of jumps to
+    exit the list.
+
+    '''
+
+    instructionList = array('i', (int(i) for i in instructionString))
+
+    return followInstructionArray(instructionList, method)
+
+def followInstructionArray(instructionList, method=1):
+    '''
+    Runs the jump instructions in an array('i') (or anything else indexable) in place,
+    as followInstructionsFast does, and returns the count of jumps to exit the list.
+
+    '''
+
+    maze = JumpMaze(instructionList, method)
+    maze.run()
+    maze.sync()
+
+    return maze.counter
+
+class JumpMaze(object):
+    '''
+    The state of a run through a list of jump instructions: the instructions as they've been
+    changed so far, the cursor and the count of jumps. A run can be stopped after a number of
+    jumps and carried on later, and checkpointed to a file in between.
+
+    For method 2, the settled prefix of the instructions is packed into blocks that are crossed
+    a block at a time (see buildBlockTables). Call sync() to write the blocks back into the
+    instructions before looking at them.
+
+    '''
+    _HEADER = struct.Struct('<8sBqqq') # magic, method, cursor, counter, number of instructions
+    _MAGIC = b'AOCJUMPS'
+
+    def __init__(self, instructionList, method=1, index=0, counter=0):
+        '''
+        'instructionList' is an array('i') of jumps, changed in place as the maze is run.
+
+        '''
+        self.instructionList = instructionList
+        self.method = method
+        self.index = index
+        self.counter = counter
+
+        # Packed states for the settled blocks at the start of the list
+        self._blocks = []
+
+        # Offsets before this one are all 2s and 3s. Offsets only ever move towards 2 and 3
+        # and then stay there, so it only moves forward.
+        self._firstUnsettled = 0
+
+        if method == 2:
+            self._settle()
+
+    @property
+    def exited(self):
+        '''
+        True once the cursor has jumped out of the list.
+
+        '''
+        return not 0 <= self.index < len(self.instructionList)
+
+    def _settle(self):
+        '''
+        Extends the settled region, packing any blocks that are now full of 2s and 3s.
+
+        '''
+        instructionList = self.instructionList
+        nInstructions = len(instructionList)
+        firstUnsettled = self._firstUnsettled
+        shift = BLOCK_BITS.bit_length() - 1
+
+        while firstUnsettled < nInstructions and instructionList[firstUnsettled] in (2, 3):
+            firstUnsettled += 1
+
+        while (len(self._blocks) + 1) << shift <= firstUnsettled:
+            start = len(self._blocks) << shift
+            self._blocks.append(sum((instructionList[start + bit] - 2) << bit for bit in range(BLOCK_BITS)))
+
+        self._firstUnsettled = firstUnsettled
+
+    def run(self, maxJumps=None):
+        '''
+        Jumps until the cursor leaves the list, or until about maxJumps more jumps have been made
+        (crossing a block can go over by less than BLOCK_BITS). Returns the count of jumps so far.
+
+        '''
+
+        global BLOCK_TABLES
+
+        instructionList = self.instructionList
+        nInstructions = len(instructionList)
+        index = self.index
+        counter = self.counter
+        stopCounter = counter + maxJumps if maxJumps is not None else counter + (1 << 62)
+
+        if self.method != 2:
+            while 0 <= index < nInstructions and counter < stopCounter:
+                jump = instructionList[index]
+                instructionList[index] = jump + 1
+                index += jump
+                counter += 1
+
+            self.index = index
+            self.counter = counter
+
+            return counter
+
+        if BLOCK_TABLES is None:
+            BLOCK_TABLES = buildBlockTables()
+
+        (nextStates, blockSteps, exitPositions) = BLOCK_TABLES
+        shift = BLOCK_BITS.bit_length() - 1
+        blocks = self._blocks
+        nBlocks = len(blocks)
+
+        while 0 <= index < nInstructions and counter < stopCounter:
+            block = index >> shift
+
+            if block < nBlocks:
+                # In the settled region, cross blocks a whole block at a time,
+                # stopping at a block boundary once enough jumps have been made
+                position = index & BLOCK_MASK
+                while block < nBlocks and counter < stopCounter:
+                    key = (blocks[block] << shift) | position
+                    blocks[block] = nextStates[key]
+                    counter += blockSteps[key]
+                    position = exitPositions[key]
+                    block += 1
+
+                index = (block << shift) | position
+                continue
+
+            # Otherwise, one jump at a time as usual
+            jump = instructionList[index]
+            counter += 1
+
+            if jump >= 3:
+                instructionList[index] = jump - 1
+            else:
+                instructionList[index] = jump + 1
+
+            if index == self._firstUnsettled and instructionList[index] in (2, 3):
+                self._settle()
+                nBlocks = len(blocks)
+
+            index += jump
+
+        self.index = index
+        self.counter = counter
+
+        return counter
+
+    def sync(self):
+        '''
+        Writes the packed blocks back into the instructions, so they're as the jumps left them.
+
+        '''
+        shift = BLOCK_BITS.bit_length() - 1
+
+        for (block, state) in enumerate(self._blocks):
+            start = block << shift
+            for bit in range(BLOCK_BITS):
+                self.instructionList[start + bit] = 2 + ((state >> bit) & 1)
+
+    def saveCheckpoint(self, fileName):
+        '''
+        Writes the method, cursor, counter and instructions to a binary checkpoint file.
+
+        The checkpoint is written to a temporary file first and then moved into place, so a
+        run that dies part way through writing leaves the previous checkpoint intact.
+
+        '''
+        self.sync()
+
+        temporaryName = fileName + '.tmp'
+
+        with open(temporaryName, 'wb') as checkpointFile:
+            checkpointFile.write(self._HEADER.pack(self._MAGIC, self.method, self.index, self.counter,
+                                                   len(self.instructionList)))
+            checkpointFile.write(memoryview(self.instructionList).cast('B'))
+
+        os.replace(temporaryName, fileName)
+
+    @classmethod
+    def loadCheckpoint(cls, fileName):
+        '''
+        Restores a maze from a checkpoint written by saveCheckpoint.
+
+        '''
+        with open(fileName, 'rb') as checkpointFile:
+            (magic, method, index, counter, nInstructions) = cls._HEADER.unpack(checkpointFile.read(cls._HEADER.size))
+
+            if magic != cls._MAGIC:
+                raise ValueError('{0} is not a jump maze checkpoint'.format(fileName))
+
+            instructionList = array('i')
+            instructionList.fromfile(checkpointFile, nInstructions)
+
+        return cls(instructionList, method, index, counter)
+
+def followInstructionsResumable(instructionString, method=1, checkpointFile=None, checkpointInterval=10000000,
+                                progressCallback=None):
+    '''
+    Same as followInstructionsFast, but for long runs that need to survive being interrupted.
+
+    Every checkpointInterval jumps, the state of the run is saved to checkpointFile and
+    progressCallback, if given, is called with (jumps so far, current index, jumps per second).
+    If checkpointFile already exists, the run carries on from it instead of starting over with
+    instructionString. The checkpoint is removed once the cursor has escaped the maze.
+
+    Output is the count of jumps to exit the list.
+
+    '''
+
+    if checkpointFile is not None and os.path.exists(checkpointFile):
+        maze = JumpMaze.loadCheckpoint(checkpointFile)
+
+        if maze.method != method:
+            raise ValueError('Checkpoint {0} is for method {1:d}, not {2:d}'.format(checkpointFile, maze.method, method))
+    else:
+        maze = JumpMaze(array('i', (int(i) for i in instructionString)), method)
+
+    while not maze.exited:
+        startCounter = maze.counter
+        startTime = time.perf_counter()
+
+        maze.run(checkpointInterval)
+
+        elapsed = time.perf_counter() - startTime
+
+        if checkpointFile is not None and not maze.exited:
+            maze.saveCheckpoint(checkpointFile)
+
+        if progressCallback is not None:
+            progressCallback(maze.counter, maze.index, (maze.counter - startCounter) / elapsed if elapsed > 0 else 0.0)
+
+    if checkpointFile is not None and os.path.exists(checkpointFile):
+        os.remove(checkpointFile)
+
+    return maze.counter
+
+def loadInstructionBuffer(fileName, useCache=True):
+    '''
+    Loads a file of jump instructions, one per line, into a NumPy int32 buffer without going
+    through a list of strings or Python integers.
+
+    The first time a file is loaded, the parsed buffer is also saved next to it as a binary
+    cache. Later loads memory-map the cache copy-on-write, so they start immediately and only
+    the pages the jumps actually change take up memory. Changes never reach the cache.
+
+    The cache records the size and modification time (in ns) of the text file it came from,
+    and is rebuilt unless both still match exactly, so a file replaced by one with an older
+    time (cp -p, rsync -t, a git checkout) isn't mistaken for the one that was cached.
+
+    Returns a writable int32 NumPy array (or memmap).
+
+    '''
+
+    cacheName = fileName + CACHE_SUFFIX
+
+    # Taken before parsing, so a file changed while it's being read won't match next time
+    sourceStat = os.stat(fileName)
+    expectedHeader = CACHE_HEADER.pack(CACHE_MAGIC, sourceStat.st_size, sourceStat.st_mtime_ns)
+
+    if useCache and os.path.exists(cacheName):
+        with open(cacheName, 'rb') as cacheFile:
+            header = cacheFile.read(CACHE_HEADER.size)
+
+        if header == expectedHeader:
+            if os.path.getsize(cacheName) == CACHE_HEADER.size:
+                return numpy.zeros(0, dtype=numpy.int32)
+            return numpy.memmap(cacheName, dtype=numpy.int32, mode='c', offset=CACHE_HEADER.size)
+
+    # Parse the text directly into int32s
+    instructionBuffer = numpy.fromfile(fileName, dtype=numpy.int32, sep=' ')
+
+    if useCache:
+        # Not being able to write the cache only costs speed next time
+        try:
+            temporaryName = cacheName + '.tmp'
+            with open(temporaryName, 'wb') as cacheFile:
+                cacheFile.write(expectedHeader)
+                instructionBuffer.tofile(cacheFile)
+            os.replace(temporaryName, cacheName)
+        except OSError:
+            pass
+
+    return instructionBuffer
+
+def followInstructionBuffer(instructionBuffer, method=1):
+    '''
+    Runs the jump instructions in a buffer from loadInstructionBuffer, in place, using the
+    same engine as followInstructionsFast. Returns the count of jumps to exit the list.
+
+    '''
+
+    # A memoryview gives fast access to the int32s as plain Python integers
+    return followInstructionArray(memoryview(instructionBuffer).cast('B').cast('i'), method)
+
 # Unit tests
 
 class TestJumps(unittest.TestCase):
@@ -84,8 +450,110 @@ class TestJumps(unittest.TestCase):
         # Test the row checksum algorithm
         self.assertEqual(followInstructions(TEST_INSTRUCTIONS, 2), 10)
 
+    # Faster engine against the reference
+
+    def test_fast(self):
+        '''
+        Faster engine tests
+
+        '''
+
+        self.assertEqual(followInstructionsFast(TEST_INSTRUCTIONS, 1), 5)
+        self.assertEqual(followInstructionsFast(TEST_INSTRUCTIONS, 2), 10)
+        inputInstructions = open(INPUT_FILE).readlines()
+        self.assertEqual(followInstructionsFast(inputInstructions, 1), followInstructions(inputInstructions, 1))
+
+        randomGenerator = random.Random(5)
+
+        # Mazes like the real input, that mostly jump backwards without leaving the start of the list
+        for length in (1, 15, 16, 17, 100, 150):
+            instructions = [str(randomGenerator.randint(-index, 3)) for index in range(length)]
+            for method in (1, 2):
+                self.assertEqual(followInstructionsFast(instructions, method), followInstructions(instructions, method))
+
+    # Loading into buffers
+
+    def test_buffer(self):
+        '''
+        Instruction buffer tests
+
+        '''
+
+        with tempfile.TemporaryDirectory() as directory:
+            fileName = os.path.join(directory, 'jumps.txt')
+
+            with open(fileName, 'w') as instructionFile:
+                instructionFile.write('\n'.join(TEST_INSTRUCTIONS) + '\n')
+
+            for method in (1, 2):
+                # The first load parses the text, the second maps the cache
+                for useCache in (True, True, False):
+                    instructionBuffer = loadInstructionBuffer(fileName, useCache)
+                    self.assertEqual(instructionBuffer.tolist(), [int(i) for i in TEST_INSTRUCTIONS])
+                    self.assertEqual(followInstructionBuffer(instructionBuffer, method), 5 if method == 1 else 10)
+
+                self.assertTrue(isinstance(loadInstructionBuffer(fileName), numpy.memmap))
+
+            # Replace the text with an older file, as cp -p or a checkout can, and the cache is rebuilt
+            sourceStat = os.stat(fileName)
+            with open(fileName, 'w') as instructionFile:
+                instructionFile.write('1 1 1\n')
+            os.utime(fileName, ns=(sourceStat.st_atime_ns, sourceStat.st_mtime_ns - 10 ** 9))
+
+            for useCache in (True, True):
+                self.assertEqual(loadInstructionBuffer(fileName, useCache).tolist(), [1, 1, 1])
+
+            # Or with a different size but the same time
+            with open(fileName, 'w') as instructionFile:
+                instructionFile.write('2 2 2 2\n')
+            os.utime(fileName, ns=(sourceStat.st_atime_ns, sourceStat.st_mtime_ns - 10 ** 9))
+            self.assertEqual(loadInstructionBuffer(fileName).tolist(), [2, 2, 2, 2])
+
+    # Checkpoints
+
+    def test_checkpoint(self):
+        '''
+        Checkpoint and resume tests
+
+        '''
+
+        inputInstructions = open(INPUT_FILE).readlines()[:300]
+        expected = followInstructions(inputInstructions, 2)
+
+        with tempfile.TemporaryDirectory() as directory:
+            fileName = os.path.join(directory, 'day05.checkpoint')
+            progress = []
+
+            # Stop a run part way through, and check the checkpoint is where it stopped
+            maze = JumpMaze(array('i', (int(i) for i in inputInstructions)), 2)
+            maze.run(1000)
+            maze.saveCheckpoint(fileName)
+
+            resumedMaze = JumpMaze.loadCheckpoint(fileName)
+            self.assertEqual((resumedMaze.index, resumedMaze.counter), (maze.index, maze.counter))
+            self.assertEqual(resumedMaze.instructionList, maze.instructionList)
+
+            # Runs stop within a block of the jumps asked for, even in the settled region
+            chunkedMaze = JumpMaze(array('i', (int(i) for i in inputInstructions)), 2)
+            while not chunkedMaze.exited:
+                startCounter = chunkedMaze.counter
+                chunkedMaze.run(100)
+                self.assertTrue(chunkedMaze.exited or chunkedMaze.counter - startCounter < 100 + BLOCK_BITS)
+            self.assertEqual(chunkedMaze.counter, expected)
+
+            # Then carry on from the checkpoint
+            self.assertRaises(ValueError, followInstructionsResumable, None, 1, fileName)
+            self.assertEqual(followInstructionsResumable(None, 2, fileName, 5000,
+                                                         lambda *args: progress.append(args)), expected)
+            self.assertFalse(os.path.exists(fileName))
+            self.assertEqual(progress[-1][0], expected)
+            self.assertTrue(all(counter > maze.counter for (counter, index, rate) in progress))
+
+            self.assertEqual(followInstructionsResumable(inputInstructions, 1, fileName, 5000),
+                             followInstructions(inputInstructions, 1))
+
 if __name__ == '__main__':
 
     print('Advent of Code\nDay 5: A Maze of Twisty Trampolines, All Alike\n')
-    print('Part 1: {0:d} instructions to escape the maze'.format(followInstructions(INPUT_INSTRUCTIONS)))
-    print('Part 2: {0:d} instructions to escape the maze'.format(followInstructions(INPUT_INSTRUCTIONS, 2)))
+    print('Part 1: {0:d} instructions to escape the maze'.format(followInstructionBuffer(loadInstructionBuffer(INPUT_FILE))))
+    print('Part 2: {0:d} instructions to escape the maze'.format(followInstructionBuffer(loadInstructionBuffer(INPUT_FILE), 2)))
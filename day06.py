@@ -4,7 +4,16 @@ Day 6: Memory Reallocation
 
 '''
 
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import tracemalloc
 import unittest
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import numpy
 
 TEST_BANKS = ('0 2 7 0', 5, 4)
 INPUT_BANKS = '0	5	10	0	11	14	13	4	11	8	8	7	1	4	12	11'
@@ -56,6 +65,372 @@ def findInfiniteLoop(memoryBanks):
 
     return (nIterations, sizeOfLoop)
 
+def reallocate(memoryBanks):
+    '''
+    Does one redistribution cycle on memoryBanks, in place: empties the bank with the most
+    items (the first one, if there's a tie) and hands them out one at a time to the following
+    banks, looping around.
+
+    Rather than moving the items one at a time, every bank gets its full share of the
+    items in one go, and the remainder go to the banks straight after the emptied one,
+    so a cycle costs time proportional to the number of banks, not the number of items.
+
+    '''
+
+    nBanks = len(memoryBanks)
+
+    # find the memory bank with the largest quanity
+    maximumItems = max(memoryBanks)
+    index = memoryBanks.index(maximumItems)
+
+    memoryBanks[index] = 0
+
+    (share, remainder) = divmod(maximumItems, nBanks)
+
+    if share:
+        for bank in range(nBanks):
+            memoryBanks[bank] += share
+
+    # The remainder go to the next banks along, wrapping around the end
+    for bank in range(index + 1, index + 1 + remainder):
+        memoryBanks[bank % nBanks] += 1
+
+def reallocateArray(memoryBanks):
+    '''
+    NumPy version of reallocate, for configurations with thousands of banks. Does one
+    redistribution cycle on the integer array memoryBanks, in place.
+
+    '''
+
+    nBanks = memoryBanks.size
+
+    # argmax gives the first of any tied banks, like list.index does
+    index = int(numpy.argmax(memoryBanks))
+    maximumItems = int(memoryBanks[index])
+
+    memoryBanks[index] = 0
+
+    (share, remainder) = divmod(maximumItems, nBanks)
+
+    if share:
+        memoryBanks += share
+
+    # The remainder go to a contiguous range of banks after the emptied one, which might wrap around
+    end = index + 1 + remainder
+
+    if end <= nBanks:
+        memoryBanks[index + 1:end] += 1
+    else:
+        memoryBanks[index + 1:] += 1
+        memoryBanks[:end - nBanks] += 1
+
+class BankStateCodec(object):
+    '''
+    Packs memory bank configurations into compact, fixed-width bytes keys, and back.
+
+    Reallocation never changes the total number of items, so no bank can ever hold more than
+    the total. Each bank is stored in the fewest bytes that can hold that (1, 2, 4 or 8), so a
+    state of 16 banks with under 256 items is a 16 byte key instead of a string of 30 or more.
+
+    '''
+    def __init__(self, totalItems):
+        '''
+        'totalItems' is the total number of items in the banks.
+
+        '''
+        for typeCode in ('B', 'H', 'I', 'Q'):
+            if totalItems < 1 << (8 * array(typeCode).itemsize):
+                break
+        else:
+            raise ValueError('Too many items to pack: {0:d}'.format(totalItems))
+
+        self.typeCode = typeCode
+
+    def encode(self, memoryBanks):
+        '''
+        Returns the bytes key for a list of bank counts.
+
+        '''
+        if self.typeCode == 'B':
+            return bytes(memoryBanks)
+        return array(self.typeCode, memoryBanks).tobytes()
+
+    def decode(self, key):
+        '''
+        Returns the list of bank counts for a bytes key.
+
+        '''
+        return array(self.typeCode, key).tolist()
+
+class StateHistory(object):
+    '''
+    A history of states (bytes keys) and the iteration each was first seen.
+
+    The history is kept in a dict until it passes memoryLimit bytes (roughly), then the
+    dict is moved into an SQLite table in a temporary directory and emptied, so very long
+    histories don't run out of memory. Lookups check both. SQLite keeps its index on disk
+    too (unlike dbm.dumb, which is all dbm has on some platforms), and only a small page
+    cache of it in memory.
+
+    '''
+    # Rough size of a dict entry, on top of its bytes key
+    ENTRY_OVERHEAD = 150
+
+    def __init__(self, memoryLimit=None):
+        '''
+        'memoryLimit' is the number of bytes the in-memory history may use, or None for no limit.
+
+        '''
+        self.memoryLimit = memoryLimit
+        self._recent = {}
+        self._recentSize = 0
+        self._directory = None
+        self._store = None
+
+    @property
+    def spilled(self):
+        '''
+        True once any of the history has been moved to disk.
+
+        '''
+        return self._store is not None
+
+    def get(self, key):
+        '''
+        Returns the iteration the state was first seen, or None if it hasn't been.
+
+        '''
+        iteration = self._recent.get(key)
+
+        if iteration is None and self._store is not None:
+            row = self._store.execute('SELECT iteration FROM history WHERE state = ?', (key,)).fetchone()
+            if row is not None:
+                iteration = row[0]
+
+        return iteration
+
+    def add(self, key, iteration):
+        '''
+        Records the iteration a state was first seen.
+
+        '''
+        self._recent[key] = iteration
+
+        if self.memoryLimit is not None:
+            self._recentSize += len(key) + self.ENTRY_OVERHEAD
+            if self._recentSize > self.memoryLimit:
+                self.spill()
+
+    def spill(self):
+        '''
+        Moves the in-memory history into the on-disk store.
+
+        '''
+        if self._store is None:
+            self._directory = tempfile.mkdtemp(prefix='day06-history-')
+            self._store = sqlite3.connect(os.path.join(self._directory, 'history.sqlite'))
+            # The store is thrown away at the end, so it doesn't need to survive a crash
+            self._store.execute('PRAGMA journal_mode = OFF')
+            self._store.execute('PRAGMA synchronous = OFF')
+            self._store.execute('CREATE TABLE history (state BLOB PRIMARY KEY, iteration INTEGER) WITHOUT ROWID')
+
+        # States are only added the first time they're seen, but keep the earliest just in case
+        with self._store:
+            self._store.executemany('INSERT OR IGNORE INTO history VALUES (?, ?)', self._recent.items())
+
+        self._recent = {}
+        self._recentSize = 0
+
+    def close(self):
+        '''
+        Removes the on-disk store, if there is one.
+
+        '''
+        if self._store is not None:
+            self._store.close()
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._store = None
+
+    def __enter__(self):
+        '''
+        Allows the history to be used in a with statement, closing it at the end.
+
+        '''
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def findInfiniteLoopHashed(memoryBanks, memoryLimit=None):
+    '''
+    Same as findInfiniteLoop, but keeps the history in a hash table of packed states (see
+    BankStateCodec), with the iteration each state was first seen, so checking for a repeat is
+    O(1) instead of a search of the history. Past memoryLimit bytes, the history spills to disk
+    (see StateHistory).
+
+    memoryBanks is a list of integers, and isn't changed.
+    Returns the number of iterations until an infinite loop is detected, and the size of the loop.
+
+    '''
+
+    memoryBanks = list(memoryBanks)
+    nIterations = 0
+    codec = BankStateCodec(sum(memoryBanks))
+
+    with StateHistory(memoryLimit) as history:
+        history.add(codec.encode(memoryBanks), 0)
+
+        while True:
+            reallocate(memoryBanks)
+            nIterations += 1
+
+            currentState = codec.encode(memoryBanks)
+            firstSeen = history.get(currentState)
+
+            if firstSeen is not None:
+                return (nIterations, nIterations - firstSeen)
+
+            history.add(currentState, nIterations)
+
+def findInfiniteLoopsBatch(startConfigurations, memo=None):
+    '''
+    Runs findInfiniteLoop for many starting configurations, sharing what's been learnt between runs.
+
+    The memo maps every state seen so far (packed by BankStateCodec) to a tuple of the
+    number of reallocations from that state to the start of its loop, and the size of the loop.
+    A run stops as soon as it reaches a state in the memo, since the rest of its trajectory is
+    already known, and then adds its own states to the memo for later runs.
+
+    Each start is packed with a codec for its own total, which reallocation never changes, and
+    every key is prefixed with the codec's type code, so a state always has the same key
+    whichever batch it's seen in, and states of different widths or numbers of banks never
+    share one. That makes it safe to carry a memo on from one batch to the next.
+
+    startConfigurations is a list of lists of integers, which aren't changed. memo is an
+    optional dict to carry on from, filled by an earlier batch.
+    Returns a list of (iterations until an infinite loop is detected, size of the loop) tuples,
+    one per start.
+
+    '''
+
+    if memo is None:
+        memo = {}
+
+    results = []
+
+    for memoryBanks in startConfigurations:
+        memoryBanks = list(memoryBanks)
+        codec = BankStateCodec(sum(memoryBanks))
+        keyPrefix = codec.typeCode.encode('ascii')
+        seenThisRun = {} # state: iteration
+        nIterations = 0
+
+        while True:
+            currentState = keyPrefix + codec.encode(memoryBanks)
+
+            if currentState in memo:
+                # Joined a known trajectory: the loop starts as far along as it does from here
+                (distanceToLoop, loopSize) = memo[currentState]
+                loopStart = nIterations + distanceToLoop
+                break
+
+            if currentState in seenThisRun:
+                # Found a new loop
+                loopStart = seenThisRun[currentState]
+                loopSize = nIterations - loopStart
+                break
+
+            seenThisRun[currentState] = nIterations
+            reallocate(memoryBanks)
+            nIterations += 1
+
+        # Everything seen this run leads to the same loop
+        for (state, iteration) in seenThisRun.items():
+            memo[state] = (max(loopStart - iteration, 0), loopSize)
+
+        results.append((loopStart + loopSize, loopSize))
+
+    return results
+
+def findInfiniteLoopsParallel(startConfigurations, maxWorkers=None, nShards=None):
+    '''
+    Same as findInfiniteLoopsBatch, but splits the starts into shards that are run in a pool
+    of worker processes. Each shard has its own memo, so starts whose trajectories are
+    likely to merge are best kept next to each other.
+
+    Returns a list of (iterations, loop size) tuples, one per start, in the same order.
+
+    '''
+
+    if not startConfigurations:
+        return []
+
+    if maxWorkers is None:
+        maxWorkers = os.cpu_count() or 1
+
+    if nShards is None:
+        nShards = maxWorkers
+
+    nShards = max(1, min(nShards, len(startConfigurations)))
+    shardSize = -(-len(startConfigurations) // nShards)
+    shards = [startConfigurations[start:start + shardSize] for start in range(0, len(startConfigurations), shardSize)]
+
+    results = []
+
+    with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+        for shardResults in executor.map(findInfiniteLoopsBatch, shards):
+            results.extend(shardResults)
+
+    return results
+
+def findInfiniteLoopBrent(memoryBanks):
+    '''
+    Same as findInfiniteLoop, but uses Brent's cycle detection algorithm, which only ever
+    holds a couple of states at a time instead of the whole history. It takes more
+    reallocations than findInfiniteLoopHashed, so it's for loops too long to remember.
+
+    memoryBanks is a list of integers, and isn't changed.
+    Returns the number of iterations until an infinite loop is detected, and the size of the loop.
+
+    '''
+
+    def nextState(state):
+        banks = list(state)
+        reallocate(banks)
+        return tuple(banks)
+
+    start = tuple(memoryBanks)
+
+    # Find the size of the loop: the tortoise waits at each power of two while the hare
+    # runs ahead, until the hare comes back round to it
+    power = 1
+    loopSize = 1
+    tortoise = start
+    hare = nextState(start)
+
+    while tortoise != hare:
+        if power == loopSize:
+            tortoise = hare
+            power *= 2
+            loopSize = 0
+        hare = nextState(hare)
+        loopSize += 1
+
+    # Find where the loop starts: with the hare a loop ahead of the tortoise,
+    # they first meet at the start of the loop
+    tortoise = start
+    hare = start
+    for counter in range(loopSize):
+        hare = nextState(hare)
+
+    loopStart = 0
+    while tortoise != hare:
+        tortoise = nextState(tortoise)
+        hare = nextState(hare)
+        loopStart += 1
+
+    # The first repeat is seen once the loop has been gone round once
+    return (loopStart + loopSize, loopSize)
 
 # Unit tests
 
@@ -85,9 +460,133 @@ class TestLoops(unittest.TestCase):
 
         self.assertEqual(findInfiniteLoop([int(i) for i in TEST_BANKS[0].strip().split()])[1], TEST_BANKS[2])
 
+    # Redistribution
+
+    def test_reallocate(self):
+        '''
+        Redistribution tests
+
+        '''
+
+        randomGenerator = random.Random(6)
+
+        for nBanks in (1, 2, 5, 16, 100):
+            for _ in range(20):
+                memoryBanks = [randomGenerator.randint(0, 3 * nBanks) for _ in range(nBanks)]
+                memoryBanks[randomGenerator.randrange(nBanks)] = randomGenerator.randint(0, 1000)
+
+                # One item at a time, as in findInfiniteLoop
+                expected = list(memoryBanks)
+                index = expected.index(max(expected))
+                maximumItems = expected[index]
+                expected[index] = 0
+                for counter in range(maximumItems):
+                    index = (index + 1) % nBanks
+                    expected[index] += 1
+
+                bankArray = numpy.array(memoryBanks)
+                reallocate(memoryBanks)
+                reallocateArray(bankArray)
+
+                self.assertEqual(memoryBanks, expected)
+                self.assertEqual(bankArray.tolist(), expected)
+
+    # Packed states and history
+
+    def test_packed_history(self):
+        '''
+        State codec and history tests
+
+        '''
+
+        for (memoryBanks, keySize) in (([0, 2, 7, 0], 4), ([0, 300, 1], 6), ([1, 70000], 8), ([2 ** 40], 8)):
+            codec = BankStateCodec(sum(memoryBanks))
+            key = codec.encode(memoryBanks)
+            self.assertEqual(len(key), keySize)
+            self.assertEqual(codec.decode(key), memoryBanks)
+
+        with StateHistory(memoryLimit=500) as history:
+            for iteration in range(100):
+                history.add(bytes([iteration]), iteration)
+
+            self.assertTrue(history.spilled)
+            self.assertEqual([history.get(bytes([iteration])) for iteration in range(100)], list(range(100)))
+            self.assertIsNone(history.get(b'missing'))
+
+        # Memory stays bounded however much is spilled, where a plain dict would keep growing
+        nStates = 50000
+        tracemalloc.start()
+        try:
+            with StateHistory(memoryLimit=100000) as history:
+                for iteration in range(nStates):
+                    history.add(iteration.to_bytes(16, 'little'), iteration)
+                (spilledSize, _) = tracemalloc.get_traced_memory()
+
+                self.assertTrue(history.spilled)
+                self.assertEqual(history.get((nStates // 2).to_bytes(16, 'little')), nStates // 2)
+
+            plainHistory = {}
+            startSize = tracemalloc.get_traced_memory()[0]
+            for iteration in range(nStates):
+                plainHistory[iteration.to_bytes(16, 'little')] = iteration
+            plainSize = tracemalloc.get_traced_memory()[0] - startSize
+        finally:
+            tracemalloc.stop()
+
+        self.assertLess(spilledSize, 500000)
+        self.assertGreater(plainSize, 4 * spilledSize)
+
+    # Batches
+
+    def test_batch(self):
+        '''
+        Batch loop detection tests
+
+        '''
+
+        # A start, some states along its trajectory, and some unrelated starts
+        memoryBanks = [int(i) for i in INPUT_BANKS.strip().split()]
+        startConfigurations = [list(memoryBanks)]
+
+        for _ in range(50):
+            reallocate(memoryBanks)
+            startConfigurations.append(list(memoryBanks))
+
+        startConfigurations.extend([[0, 2, 7, 0], [7, 0, 2, 0], [3], [0, 0, 0], [1, 0, 0, 0, 0, 9]])
+        expected = [findInfiniteLoopHashed(memoryBanks) for memoryBanks in startConfigurations]
+
+        memo = {}
+        self.assertEqual(findInfiniteLoopsBatch(startConfigurations, memo), expected)
+        self.assertEqual(findInfiniteLoopsBatch(startConfigurations[::-1], memo), expected[::-1])
+        self.assertEqual(findInfiniteLoopsParallel(startConfigurations, maxWorkers=2, nShards=3), expected)
+
+        self.assertEqual(findInfiniteLoopsBatch([]), [])
+
+        # A memo carried on to batches with different totals, widths and numbers of banks
+        memo = {}
+        for batch in ([[1, 0]], [[1], [300]], [[0, 1], [1, 0, 0, 0]], [[256, 0], [0, 256]], [[1, 0], [1]]):
+            self.assertEqual(findInfiniteLoopsBatch(batch, memo), [findInfiniteLoop(list(memoryBanks)) for memoryBanks in batch])
+        self.assertEqual(findInfiniteLoopsParallel([]), [])
+
+    # Faster loop detection
+
+    def test_fast(self):
+        '''
+        Hashed history and Brent's algorithm tests
+
+        '''
+
+        for banksString in (TEST_BANKS[0], INPUT_BANKS, '0', '3 0', '1 1 1 1'):
+            memoryBanks = [int(i) for i in banksString.strip().split()]
+            expected = findInfiniteLoop(list(memoryBanks))
+
+            self.assertEqual(findInfiniteLoopHashed(memoryBanks), expected)
+            self.assertEqual(findInfiniteLoopHashed(memoryBanks, memoryLimit=2000), expected)
+            self.assertEqual(findInfiniteLoopBrent(memoryBanks), expected)
+
 if __name__ == '__main__':
 
     print('Advent of Code\nDay 6: Memory Reallocation\n')
-    (iterations, loopSize) = findInfiniteLoop([int(i) for i in INPUT_BANKS.strip().split()])
+    (iterations, loopSize) = findInfiniteLoopHashed([int(i) for i in INPUT_BANKS.strip().split()])
     print('Part 1: {0:d} iterations to infinite loop'.format(iterations))
     print('Part 2: The loop is {0:d} iterations'.format(loopSize))
@@ -4,8 +4,14 @@ Day 7: Recursive Circus
 
 '''
 
+import random
+import sys
+import time
 import unittest
+from array import array
 from collections import Counter
+from itertools import accumulate, chain, repeat
+import numpy
 
 TEST_TREE = '''pbga (66)
 xhth (57)
@@ -28,6 +34,8 @@ class Node(object):
     A node in a tree with a parent (or not) and children (or none) and weight
 
     '''
+    __slots__ = ('name', 'weight', 'parent', 'children', 'totalWeight')
+
     def __init__(self, name, weight=0):
         self.name = name
         self.weight = weight
@@ -35,6 +43,28 @@ class Node(object):
         self.children = []
         self.totalWeight = 0
 
+def parseTreeRow(row):
+    '''
+    Parses one node definition of the form
+
+    <node name> (<weight>) -> <child name 1>, <child name 2>, <...>
+
+    Returns a tuple of (name, weight, list of child names).
+
+    '''
+
+    rowBits = row.split('->')
+    name, weightString = rowBits[0].strip().split(' ')
+    weight = int(weightString.replace('(', '').replace(')', ''))
+
+    # check to see if any children were defined
+    if len(rowBits) > 1:
+        children = [item.strip() for item in rowBits[1].strip().split(',')]
+    else:
+        children = []
+
+    return (name, weight, children)
+
 def buildTree(treeList):
     '''
     Build up a tree of Nodes from the string instructions
@@ -45,51 +75,44 @@ def buildTree(treeList):
 
     '''
 
-    hasNoParent = [] # list of nodes without parents
+    hasNoParent = set() # nodes without parents
     nodeIndex = {} # keep an index of nodes for easy reference nodeName: Node
 
     # parse the input
     for row in treeList:
-        rowBits = row.split('->')
-        name, weightString = rowBits[0].strip().split(' ')
-        weight=int(weightString.replace('(','').replace(')',''))
+        (name, weight, children) = parseTreeRow(row)
 
         # if the name isn't in the node index, it's a new node
         if name not in nodeIndex:
             newNode = Node(name, weight)
             nodeIndex[name] = newNode
-            hasNoParent.append(newNode)
+            hasNoParent.add(newNode)
         else:
             # here if the node was created as a child node, but without weight details
             newNode = nodeIndex[name]
             newNode.weight = weight
 
-        # check to see if any children were defined
-        if len(rowBits) > 1:
-            children = [item.strip() for item in rowBits[1].strip().split(',')]
-
-            # step through all the children, create the parent-child relationships
-            # create new nodes if they haven't already been created
+        # step through all the children, create the parent-child relationships
+        # create new nodes if they haven't already been created
 
-            for child in children:
-                if child not in nodeIndex.keys():
-                    # Haven't seen this name before, create a node
-                    childNode = Node(child)
-                    nodeIndex[child] = childNode
-                else:
-                    # We have seen this name before, grab the node
-                    childNode = nodeIndex[child]
+        for child in children:
+            if child not in nodeIndex:
+                # Haven't seen this name before, create a node
+                childNode = Node(child)
+                nodeIndex[child] = childNode
+            else:
+                # We have seen this name before, grab the node
+                childNode = nodeIndex[child]
 
-                # If the childNode is in the hasNoParent list, un-orphan it
-                if childNode in hasNoParent:
-                    hasNoParent.remove(childNode)
+            # If the childNode is in the hasNoParent set, un-orphan it
+            hasNoParent.discard(childNode)
 
-                # Create the familial relationships
-                newNode.children.append(childNode)
-                childNode.parent = newNode
+            # Create the familial relationships
+            newNode.children.append(childNode)
+            childNode.parent = newNode
 
     # Only one node should have no parent, and that's the root node
-    rootNode = hasNoParent[0]
+    rootNode = next(iter(hasNoParent))
 
     return(rootNode)
 
@@ -97,19 +120,190 @@ def findBranchWeights(node):
     '''
     Build up the total weights of each node by adding up the total weight of its children
 
-    Recursive to properly navigate the tree. Returns nothing.
+    Walks the tree in post-order with an explicit stack, rather than recursing, so deep
+    trees don't hit the recursion limit. Returns nothing.
+
+    '''
+
+    # Each node goes on the stack twice: once to put its children on the stack,
+    # and again, once they're all done, to add up their total weights
+    stack = [(node, False)]
+
+    while stack:
+        (currentNode, childrenDone) = stack.pop()
+
+        if childrenDone:
+            # Start the weight from the node's own weight, and add the total weight of all children
+            currentNode.totalWeight = currentNode.weight
+            for childNode in currentNode.children:
+                currentNode.totalWeight += childNode.totalWeight
+        else:
+            stack.append((currentNode, True))
+            stack.extend((childNode, False) for childNode in currentNode.children)
+
+def findImbalances(rootNode):
+    '''
+    Finds every imbalance in the tree in one post-order pass, for trees with more than one fault.
+    Total weights are filled in along the way, as findBranchWeights does.
+
+    Returns a list of (node, odd child, corrected weight) tuples, one per node whose children
+    don't all have the same total weight, children before parents. The odd child is the one
+    whose total weight differs from all its siblings, and the corrected weight is the weight it
+    needs to match them. Both are None if the odd one out can't be told (two children, or more
+    than two different total weights). A node whose imbalance is caused by a fault further up
+    is reported too; the fault itself is an odd child that isn't imbalanced itself.
 
     '''
 
-    # Start the weight from the node's own weight
-    node.totalWeight = node.weight
+    imbalances = []
+
+    stack = [(rootNode, False)]
+
+    while stack:
+        (currentNode, childrenDone) = stack.pop()
+
+        if not childrenDone:
+            stack.append((currentNode, True))
+            stack.extend((childNode, False) for childNode in currentNode.children)
+            continue
+
+        # The children are all done: add up the total weight, and keep track of how often
+        # each total weight turns up among the children, and the first child with it
+        currentNode.totalWeight = currentNode.weight
+        seenWeights = {} # total weight: [count, first child]
+
+        for childNode in currentNode.children:
+            currentNode.totalWeight += childNode.totalWeight
+
+            seen = seenWeights.get(childNode.totalWeight)
+            if seen is None:
+                seenWeights[childNode.totalWeight] = [1, childNode]
+            else:
+                seen[0] += 1
+
+        if len(seenWeights) <= 1:
+            continue
+
+        oddChild = None
+        correctedWeight = None
+
+        if len(seenWeights) == 2:
+            # One of the two weights has to turn up once, and the other more than once
+            ((weight1, (count1, child1)), (weight2, (count2, child2))) = seenWeights.items()
+
+            if count1 == 1 and count2 > 1:
+                (oddChild, commonTotalWeight) = (child1, weight2)
+            elif count2 == 1 and count1 > 1:
+                (oddChild, commonTotalWeight) = (child2, weight1)
+
+            if oddChild is not None:
+                correctedWeight = oddChild.weight + commonTotalWeight - oddChild.totalWeight
+
+        imbalances.append((currentNode, oddChild, correctedWeight))
+
+    return imbalances
+
+class CompactTree(object):
+    '''
+    A tree stored as parallel arrays instead of Node objects, for very large towers.
+
+    Node names are interned to integer ids (their order of definition, then any children that
+    are never defined themselves). For each id, the arrays hold the weight, the parent id (-1
+    for none), and, in compressed sparse row form, the children: the children of node i are
+    childIDs[childOffsets[i]:childOffsets[i + 1]].
+
+    '''
+    __slots__ = ('names', 'nameIndex', 'weights', 'parents', 'childOffsets', 'childIDs', 'rootID')
+
+    def __init__(self, treeList):
+        '''
+        'treeList' is an iterable of node definitions, as for buildTree.
+
+        '''
+        # Parse everything into flat lists first, so the arrays can be built in one go each
+        self.names = []
+        weights = []
+        childCounts = []
+        childNames = []
+
+        for row in treeList:
+            (name, weight, children) = parseTreeRow(row)
+            self.names.append(name)
+            weights.append(weight)
+            childCounts.append(len(children))
+            childNames.extend(children)
+
+        self.nameIndex = dict(zip(self.names, range(len(self.names)))) # name: id
+
+        try:
+            childIDs = list(map(self.nameIndex.__getitem__, childNames))
+        except KeyError:
+            # Children that are never defined get ids at the end, with no weight or children
+            for name in childNames:
+                if name not in self.nameIndex:
+                    self.nameIndex[name] = len(self.names)
+                    self.names.append(name)
+                    weights.append(0)
+                    childCounts.append(0)
+            childIDs = list(map(self.nameIndex.__getitem__, childNames))
+
+        nNodes = len(self.names)
+        self.weights = array('q', weights)
+        self.childOffsets = array('q', accumulate(childCounts, initial=0))
+        self.childIDs = array('q', childIDs)
+
+        # The parent of each entry in childIDs, in the same order
+        parentIDs = chain.from_iterable(map(repeat, range(nNodes), childCounts))
+
+        self.parents = array('q', [-1]) * nNodes
+        parents = self.parents
+        for (childID, parentID) in zip(childIDs, parentIDs):
+            parents[childID] = parentID
+
+        # Only one node should have no parent, and that's the root node
+        try:
+            self.rootID = parents.index(-1)
+        except ValueError:
+            self.rootID = -1
+
+    def children(self, nodeID):
+        '''
+        Returns the ids of a node's children.
+
+        '''
+        return self.childIDs[self.childOffsets[nodeID]:self.childOffsets[nodeID + 1]]
+
+    def topDownOrder(self):
+        '''
+        Returns the node ids in breadth-first order from the root, so every node comes
+        after its parent.
+
+        '''
+        order = [self.rootID]
+        childOffsets = self.childOffsets
+        childIDs = self.childIDs
+
+        for nodeID in order:
+            for index in range(childOffsets[nodeID], childOffsets[nodeID + 1]):
+                order.append(childIDs[index])
 
-    # Add the total weight of all children
-    # But make sure they're updated first
+        return order
 
-    for childNode in node.children:
-        findBranchWeights(childNode)
-        node.totalWeight += childNode.totalWeight
+    def findTotalWeights(self):
+        '''
+        Returns an array of the total weight of each node and everything above it,
+        adding each node into its parent, children first.
+
+        '''
+        totalWeights = array('q', self.weights)
+        parents = self.parents
+
+        for nodeID in reversed(self.topDownOrder()):
+            parentID = parents[nodeID]
+            if parentID >= 0:
+                totalWeights[parentID] += totalWeights[nodeID]
+
+        return totalWeights
 
 def findNewWeight(rootNode):
     '''
@@ -159,6 +353,299 @@ def findNewWeight(rootNode):
 
     return currentNode
 
+class ColumnarTree(object):
+    '''
+    A tree held entirely in NumPy arrays, for bulk analysis of very large towers.
+
+    Node names are interned to integer ids, and each id has a weight and a parent id (-1 for
+    the root). Depths are found once, by pointer jumping, and the total weights are added up
+    level by level from the top of the tower down to the root.
+
+    '''
+    def __init__(self, treeList):
+        '''
+        'treeList' is an iterable of node definitions, as for buildTree.
+
+        '''
+        self.names = []
+        nameIndex = {} # name: id
+        weights = []
+        childIDs = []
+        parentIDs = []
+
+        def intern(name):
+            nodeID = nameIndex.get(name)
+            if nodeID is None:
+                nodeID = len(self.names)
+                nameIndex[name] = nodeID
+                self.names.append(name)
+                weights.append(0)
+            return nodeID
+
+        for row in treeList:
+            (name, weight, children) = parseTreeRow(row)
+            nodeID = intern(name)
+            weights[nodeID] = weight
+            for child in children:
+                childIDs.append(intern(child))
+                parentIDs.append(nodeID)
+
+        nNodes = len(self.names)
+        self.weights = numpy.array(weights, dtype=numpy.int64)
+        self.parents = numpy.full(nNodes, -1, dtype=numpy.int64)
+        self.parents[numpy.array(childIDs, dtype=numpy.int64)] = numpy.array(parentIDs, dtype=numpy.int64)
+
+        # Only one node should have no parent, and that's the root node
+        self.rootID = int(numpy.flatnonzero(self.parents < 0)[0])
+
+        self.depths = self._findDepths()
+        self.totalWeights = self._findTotalWeights()
+
+    def _findDepths(self):
+        '''
+        Finds the depth of every node by pointer jumping: each pass adds on the depth of the
+        ancestor each node currently points at, then points at that ancestor's ancestor, so
+        the number of passes only grows with the log of the depth of the tower.
+
+        '''
+        hasAncestor = self.parents >= 0
+        depths = hasAncestor.astype(numpy.int64)
+        ancestors = self.parents.copy()
+
+        while hasAncestor.any():
+            safeAncestors = numpy.where(hasAncestor, ancestors, 0)
+            depths = numpy.where(hasAncestor, depths + depths[safeAncestors], depths)
+            ancestors = numpy.where(hasAncestor, ancestors[safeAncestors], -1)
+            hasAncestor = ancestors >= 0
+
+        return depths
+
+    def _findTotalWeights(self):
+        '''
+        Adds up the total weights, one level of the tower at a time, deepest first.
+
+        '''
+        totalWeights = self.weights.copy()
+
+        # Group the node ids by depth
+        order = numpy.argsort(self.depths, kind='stable')
+        levelStarts = numpy.searchsorted(self.depths[order], numpy.arange(self.depths.max() + 2))
+
+        for depth in range(int(self.depths.max()), 0, -1):
+            levelNodes = order[levelStarts[depth]:levelStarts[depth + 1]]
+            numpy.add.at(totalWeights, self.parents[levelNodes], totalWeights[levelNodes])
+
+        return totalWeights
+
+    @property
+    def rootName(self):
+        '''
+        The name of the root node.
+
+        '''
+        return self.names[self.rootID]
+
+    def findImbalanced(self):
+        '''
+        Returns the ids of the nodes whose children don't all have the same total weight.
+
+        '''
+        children = numpy.flatnonzero(self.parents >= 0)
+        minimumChildWeights = numpy.full(self.parents.size, numpy.iinfo(numpy.int64).max)
+        maximumChildWeights = numpy.full(self.parents.size, numpy.iinfo(numpy.int64).min)
+
+        numpy.minimum.at(minimumChildWeights, self.parents[children], self.totalWeights[children])
+        numpy.maximum.at(maximumChildWeights, self.parents[children], self.totalWeights[children])
+
+        return numpy.flatnonzero((maximumChildWeights != minimumChildWeights) &
+                                 (maximumChildWeights != numpy.iinfo(numpy.int64).min))
+
+    def findNewWeight(self):
+        '''
+        Same as findNewWeight, but with array operations: the node to change is the odd child
+        of the deepest imbalanced node. Returns a tuple of (node name, corrected weight), or
+        None if the tower is balanced or the odd child can't be told (two children, or more
+        than two different total weights).
+
+        '''
+        imbalanced = self.findImbalanced()
+
+        if imbalanced.size == 0:
+            return None
+
+        deepest = imbalanced[numpy.argmax(self.depths[imbalanced])]
+        children = numpy.flatnonzero(self.parents == deepest)
+
+        (childWeights, counts) = numpy.unique(self.totalWeights[children], return_counts=True)
+
+        # The odd one out can only be told with two weights, one turning up once and the
+        # other more than once, as in findImbalances
+        if childWeights.size != 2 or counts.min() != 1 or counts.max() == 1:
+            return None
+
+        commonTotalWeight = childWeights[numpy.argmax(counts)]
+        oddChild = children[self.totalWeights[children] != commonTotalWeight][0]
+
+        return (self.names[oddChild], int(self.weights[oddChild] + commonTotalWeight - self.totalWeights[oddChild]))
+
+class Tower(object):
+    '''
+    A tree of Nodes that can have weights changed on the fly, for asking lots of
+    "what if this weight changed?" questions of the same tower.
+
+    Total weights are kept up to date by adding the change to each ancestor, and each node
+    keeps a count of its children's total weights, so changing a weight costs O(depth) rather
+    than recalculating the whole tree. The set of imbalanced nodes (with children that
+    don't all have the same total weight) is kept up to date at the same time.
+
+    '''
+    def __init__(self, treeList):
+        '''
+        'treeList' is an iterable of node definitions, as for buildTree.
+
+        '''
+        self.root = buildTree(treeList)
+        findBranchWeights(self.root)
+
+        self.nodes = {} # nodeName: Node
+        self.imbalanced = set() # names of the imbalanced nodes
+        self._childWeights = {} # nodeName: Counter of the children's total weights
+
+        stack = [self.root]
+
+        while stack:
+            node = stack.pop()
+            self.nodes[node.name] = node
+            self._childWeights[node.name] = Counter(childNode.totalWeight for childNode in node.children)
+            if len(self._childWeights[node.name]) > 1:
+                self.imbalanced.add(node.name)
+            stack.extend(node.children)
+
+    def setWeight(self, name, weight):
+        '''
+        Changes the weight of a node, updating the total weights and imbalances above it.
+
+        '''
+        node = self.nodes[name]
+        deltaWeight = weight - node.weight
+        node.weight = weight
+
+        if deltaWeight == 0:
+            return
+
+        # Walk down to the root, moving each node's total weight to its new value
+        # in its parent's count
+        while node is not None:
+            oldTotalWeight = node.totalWeight
+            node.totalWeight += deltaWeight
+
+            parent = node.parent
+
+            if parent is not None:
+                childWeights = self._childWeights[parent.name]
+                childWeights[oldTotalWeight] -= 1
+                if childWeights[oldTotalWeight] == 0:
+                    del childWeights[oldTotalWeight]
+                childWeights[node.totalWeight] += 1
+
+                if len(childWeights) > 1:
+                    self.imbalanced.add(parent.name)
+                else:
+                    self.imbalanced.discard(parent.name)
+
+            node = parent
+
+    def findOddChild(self, name):
+        '''
+        Returns the child of an imbalanced node whose total weight is different from all
+        its siblings, and the total weight the siblings share. Returns None if the node is
+        balanced, or the odd one out can't be told (two children, or more than two weights).
+
+        '''
+        childWeights = self._childWeights[name]
+
+        if len(childWeights) != 2:
+            return None
+
+        ((commonTotalWeight, commonCount), (oddTotalWeight, oddCount)) = childWeights.most_common()
+
+        if oddCount != 1 or commonCount == 1:
+            return None
+
+        for childNode in self.nodes[name].children:
+            if childNode.totalWeight == oddTotalWeight:
+                return (childNode, commonTotalWeight)
+
+        return None
+
+    def findCorrections(self):
+        '''
+        Finds the weight changes that would fix the imbalances in the tower.
+
+        The node to fix is the odd child of an imbalanced node that's balanced itself (if it
+        weren't, the fault would be further up). Returns a dict of nodeName: corrected weight.
+
+        '''
+        corrections = {}
+
+        for name in self.imbalanced:
+            oddChild = self.findOddChild(name)
+
+            if oddChild is not None and oddChild[0].name not in self.imbalanced:
+                (childNode, commonTotalWeight) = oddChild
+                corrections[childNode.name] = childNode.weight + commonTotalWeight - childNode.totalWeight
+
+        return corrections
+
+def generateTower(nNodes, seed=7):
+    '''
+    Returns node definitions, in random order, for a random tower of nNodes nodes. Each node
+    sits on one of the 50 before it, so the tower is both wide and deep.
+
+    '''
+    randomGenerator = random.Random(seed)
+    children = [[] for _ in range(nNodes)]
+
+    for nodeID in range(1, nNodes):
+        children[randomGenerator.randrange(max(0, nodeID - 50), nodeID)].append(nodeID)
+
+    treeList = []
+    for nodeID in randomGenerator.sample(range(nNodes), nNodes):
+        row = 'n{0:d} ({1:d})'.format(nodeID, randomGenerator.randint(1, 99))
+        if children[nodeID]:
+            row += ' -> ' + ', '.join('n{0:d}'.format(childID) for childID in children[nodeID])
+        treeList.append(row)
+
+    return treeList
+
+def benchmarkTrees(nNodes=1000000):
+    '''
+    Times building and weighing a random tower of nNodes nodes as Nodes (buildTree and
+    findBranchWeights) and as a CompactTree.
+
+    '''
+    treeList = generateTower(nNodes)
+
+    print('Tower of {0:d} nodes'.format(nNodes))
+    print('{0:>12s} {1:>10s} {2:>10s} {3:>10s}'.format('', 'build (s)', 'weigh (s)', 'total (s)'))
+
+    startTime = time.perf_counter()
+    rootNode = buildTree(treeList)
+    builtTime = time.perf_counter()
+    findBranchWeights(rootNode)
+    endTime = time.perf_counter()
+    print('{0:>12s} {1:10.2f} {2:10.2f} {3:10.2f}'.format('Node', builtTime - startTime, endTime - builtTime, endTime - startTime))
+
+    startTime = time.perf_counter()
+    tree = CompactTree(treeList)
+    builtTime = time.perf_counter()
+    totalWeights = tree.findTotalWeights()
+    endTime = time.perf_counter()
+    print('{0:>12s} {1:10.2f} {2:10.2f} {3:10.2f}'.format('CompactTree', builtTime - startTime, endTime - builtTime, endTime - startTime))
+
+    if totalWeights[tree.rootID] != rootNode.totalWeight:
+        raise RuntimeError('Total weights differ: {0:d} and {1:d}'.format(totalWeights[tree.rootID], rootNode.totalWeight))
+
 # Unit tests
 
 class TestLoops(unittest.TestCase):
@@ -190,11 +677,146 @@ class TestLoops(unittest.TestCase):
         newWeight = findNewWeight(buildTree(TEST_TREE.splitlines()))
         self.assertEqual(newWeight.weight, 60)
 
+    # Compact trees and deep trees
+
+    def test_compact(self):
+        '''
+        Compact tree tests
+
+        '''
+
+        tree = CompactTree(TEST_TREE.splitlines())
+        self.assertEqual(tree.names[tree.rootID], 'tknk')
+
+        totalWeights = tree.findTotalWeights()
+        self.assertEqual(totalWeights[tree.rootID], 778)
+        self.assertEqual(sorted(totalWeights[childID] for childID in tree.children(tree.rootID)), [243, 243, 251])
+        self.assertEqual(tree.names[tree.parents[tree.nameIndex['pbga']]], 'padx')
+
+        # Children that are never defined have no weight or children
+        tree = CompactTree(['a (1) -> b, c', 'b (2)'])
+        self.assertEqual((tree.names, tree.rootID), (['a', 'b', 'c'], 0))
+        self.assertEqual(list(tree.findTotalWeights()), [3, 2, 0])
+        self.assertEqual(list(tree.children(tree.nameIndex['c'])), [])
+
+        treeList = generateTower(2000)
+        rootNode = buildTree(treeList)
+        findBranchWeights(rootNode)
+        tree = CompactTree(treeList)
+        self.assertEqual(tree.names[tree.rootID], rootNode.name)
+        self.assertEqual(tree.findTotalWeights()[tree.rootID], rootNode.totalWeight)
+        self.assertEqual(len(tree.topDownOrder()), 2000)
+
+        rootNode = buildTree(INPUT_TREE)
+        findBranchWeights(rootNode)
+        tree = CompactTree(INPUT_TREE)
+        self.assertEqual(tree.names[tree.rootID], rootNode.name)
+        self.assertEqual(tree.findTotalWeights()[tree.rootID], rootNode.totalWeight)
+
+    def test_columnar(self):
+        '''
+        Columnar tree tests
+
+        '''
+
+        tree = ColumnarTree(TEST_TREE.splitlines())
+        self.assertEqual(tree.rootName, 'tknk')
+        self.assertEqual(tree.totalWeights[tree.rootID], 778)
+        self.assertEqual(tree.depths[tree.names.index('pbga')], 2)
+        self.assertEqual(tree.findNewWeight(), ('ugml', 60))
+
+        rootNode = buildTree(INPUT_TREE)
+        newWeightNode = findNewWeight(rootNode)
+        tree = ColumnarTree(INPUT_TREE)
+        self.assertEqual(tree.rootName, rootNode.name)
+        self.assertEqual(tree.totalWeights[tree.rootID], rootNode.totalWeight)
+        self.assertEqual(tree.findNewWeight(), (newWeightNode.name, newWeightNode.weight))
+
+        depth = 5000
+        tree = ColumnarTree(['n{0:d} (1) -> n{1:d}'.format(i, i + 1) for i in range(depth)] + ['n{0:d} (1)'.format(depth)])
+        self.assertEqual(tree.depths.max(), depth)
+        self.assertEqual(tree.totalWeights[tree.rootID], depth + 1)
+        self.assertIsNone(tree.findNewWeight())
+
+        # The odd child can't be told
+        self.assertIsNone(ColumnarTree(['a (1) -> b, c', 'b (1)', 'c (2)']).findNewWeight())
+        self.assertIsNone(ColumnarTree(['a (1) -> b, c, d, e', 'b (1)', 'c (1)', 'd (2)', 'e (2)']).findNewWeight())
+        self.assertIsNone(ColumnarTree(['a (1) -> b, c, d', 'b (1)', 'c (2)', 'd (3)']).findNewWeight())
+
+    def test_imbalances(self):
+        '''
+        All imbalances report tests
+
+        '''
+
+        imbalances = findImbalances(buildTree(TEST_TREE.splitlines()))
+        self.assertEqual([(node.name, oddChild.name, weight) for (node, oddChild, weight) in imbalances],
+                         [('tknk', 'ugml', 60)])
+
+        # Two faults, one in padx's subtree, which makes the root ambiguous
+        imbalances = findImbalances(buildTree(TEST_TREE.replace('pbga (66)', 'pbga (67)').splitlines()))
+        report = [(node.name, oddChild and oddChild.name, weight) for (node, oddChild, weight) in imbalances]
+        self.assertEqual(report, [('padx', 'pbga', 66), ('tknk', None, None)])
+
+        imbalances = findImbalances(buildTree(['a (1) -> b, c, d, e', 'b (1)', 'c (1)', 'd (2)', 'e (2)']))
+        self.assertEqual([(node.name, oddChild, weight) for (node, oddChild, weight) in imbalances], [('a', None, None)])
+
+        rootNode = buildTree(INPUT_TREE)
+        report = {(oddChild.name, weight) for (node, oddChild, weight) in findImbalances(rootNode)}
+        newWeightNode = findNewWeight(rootNode)
+        self.assertIn((newWeightNode.name, newWeightNode.weight), report)
+
+    def test_tower(self):
+        '''
+        Weight changes and imbalance tests
+
+        '''
+
+        tower = Tower(TEST_TREE.splitlines())
+        self.assertEqual(tower.imbalanced, {'tknk'})
+        self.assertEqual(tower.findCorrections(), {'ugml': 60})
+
+        tower.setWeight('ugml', 60)
+        self.assertEqual(tower.imbalanced, set())
+        self.assertEqual(tower.findCorrections(), {})
+        self.assertEqual(tower.root.totalWeight, 770)
+
+        tower.setWeight('pbga', 70)
+        self.assertEqual(tower.imbalanced, {'padx', 'tknk'})
+        self.assertEqual(tower.findCorrections(), {'pbga': 66})
+        self.assertEqual(tower.root.totalWeight, 774)
+
+        tower = Tower(INPUT_TREE)
+        newWeightNode = findNewWeight(buildTree(INPUT_TREE))
+        self.assertEqual(tower.findCorrections(), {newWeightNode.name: newWeightNode.weight})
+
+    def test_deep_tree(self):
+        '''
+        Trees deeper than the recursion limit
+
+        '''
+
+        depth = 20000
+        treeList = ['n{0:d} (1) -> n{1:d}'.format(i, i + 1) for i in range(depth)] + ['n{0:d} (1)'.format(depth)]
+
+        rootNode = buildTree(treeList)
+        findBranchWeights(rootNode)
+        self.assertEqual((rootNode.name, rootNode.totalWeight), ('n0', depth + 1))
+
+        tree = CompactTree(treeList)
+        self.assertEqual(tree.findTotalWeights()[tree.rootID], depth + 1)
+
 
 
 if __name__ == '__main__':
 
     print('Advent of Code\nDay 7: Recursive Circus\n')
+
+    # Compare Nodes and CompactTree on a large tower
+    if sys.argv[1:2] == ['--benchmark']:
+        benchmarkTrees(int(sys.argv[2]) if len(sys.argv) > 2 else 1000000)
+        sys.exit()
+
     rootNode = buildTree(INPUT_TREE)
     print('Part 1: The root node name is {}'.format(rootNode.name))
 
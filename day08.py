@@ -4,6 +4,11 @@ Day 8: I Heard You Like Registers
 
 '''
 
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
 import unittest
 
 # Inputs and tests
@@ -30,6 +35,11 @@ COMPARISONS = {
 DIRECTION = {'inc': 1,
              'dec': -1}
 
+# Compiled programs are cached in memory by program hash, and on disk in this directory
+
+COMPILED_PROGRAMS = {}
+COMPILED_CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__', 'day08-programs')
+
 # Solution
 
 def doInstructions(inputStringList):
@@ -72,6 +82,168 @@ def doInstructions(inputStringList):
 
     return (max(memory.values()), absoluteMax)
 
+def parseProgram(inputStringList):
+    '''
+    Parses a list of instruction strings once, so the program can be run many times.
+
+    Register names are interned to integer slots in order of first appearance, and each
+    instruction becomes a tuple of
+
+      (register slot, signed value, test register slot, comparison function, threshold)
+
+    Returns a tuple of (list of register names, list of instruction tuples).
+
+    '''
+
+    registerNames = []
+    registerSlots = {} # register: slot
+
+    def intern(register):
+        slot = registerSlots.get(register)
+        if slot is None:
+            slot = len(registerNames)
+            registerSlots[register] = slot
+            registerNames.append(register)
+        return slot
+
+    program = []
+
+    for inputString in inputStringList:
+        (register, direction, value, ifDummy, testRegister, test, testThreshold) = inputString.split()
+
+        program.append((intern(register), DIRECTION[direction] * int(value), intern(testRegister),
+                        COMPARISONS[test], int(testThreshold)))
+
+    return (registerNames, program)
+
+def runProgram(parsedProgram):
+    '''
+    Runs a program from parseProgram, with the registers held in a list indexed by slot.
+
+    The largest value ever held is kept as a running maximum, only checked when a register
+    is written, so a program runs in time linear in its length.
+
+    Output is a tuple of (currentMax, largestMax), as for doInstructions.
+
+    '''
+
+    (registerNames, program) = parsedProgram
+
+    memory = [0] * len(registerNames)
+    absoluteMax = 0
+
+    for (slot, delta, testSlot, comparison, threshold) in program:
+        if comparison(memory[testSlot], threshold):
+            newValue = memory[slot] + delta
+            memory[slot] = newValue
+
+            if newValue > absoluteMax:
+                absoluteMax = newValue
+
+    return (max(memory, default=0), absoluteMax)
+
+def doInstructionsFast(inputStringList):
+    '''
+    Same as doInstructions, but parses the program once up front and runs it with
+    interned registers and a running maximum (see parseProgram and runProgram).
+
+    '''
+
+    return runProgram(parseProgram(inputStringList))
+
+def generateProgramSource(inputStringList):
+    '''
+    Translates a list of instruction strings into the Python source of a single function,
+    runRegisterProgram(), with a local variable for each register and the comparisons written
+    out as native operators. The function returns (currentMax, largestMax), as doInstructions does.
+
+    Registers are renamed to r0, r1, etc. in order of first appearance, and values are
+    checked as they're parsed, so nothing from the input ends up in the source as-is.
+
+    '''
+
+    (registerNames, program) = parseProgram(inputStringList)
+    operators = {comparison: operator for (operator, comparison) in COMPARISONS.items()}
+
+    lines = ['def runRegisterProgram():']
+    lines.extend('    r{0:d} = 0'.format(slot) for slot in range(len(registerNames)))
+    lines.append('    absoluteMax = 0')
+
+    for (slot, delta, testSlot, comparison, threshold) in program:
+        lines.append('    if r{0:d} {1} {2!r}:'.format(testSlot, operators[comparison], threshold))
+        lines.append('        r{0:d} += {1!r}'.format(slot, delta))
+        lines.append('        if r{0:d} > absoluteMax:'.format(slot))
+        lines.append('            absoluteMax = r{0:d}'.format(slot))
+
+    registers = ''.join('r{0:d}, '.format(slot) for slot in range(len(registerNames)))
+    lines.append('    return (max(({0}), default=0), absoluteMax)'.format(registers))
+
+    return '\n'.join(lines) + '\n'
+
+def compileProgram(inputStringList, cacheDirectory=COMPILED_CACHE_DIRECTORY):
+    '''
+    Compiles a list of instruction strings into a Python function (see generateProgramSource)
+    that runs the program and returns (currentMax, largestMax).
+
+    Functions are cached by a hash of the program, in memory and, unless cacheDirectory is
+    None, as marshalled code on disk, so running the same program again skips both the
+    parsing and the compiling.
+
+    '''
+
+    programText = '\n'.join(inputString.strip() for inputString in inputStringList)
+
+    # The marshal format depends on the Python version, so that's part of the key on disk
+    programHash = hashlib.sha256((sys.implementation.cache_tag + '\n' + programText).encode()).hexdigest()
+
+    function = COMPILED_PROGRAMS.get(programHash)
+
+    if function is not None:
+        return function
+
+    code = None
+    cacheName = None
+
+    if cacheDirectory is not None:
+        cacheName = os.path.join(cacheDirectory, programHash + '.marshal')
+
+        # A missing or unreadable cache file just means compiling again
+        try:
+            with open(cacheName, 'rb') as cacheFile:
+                code = marshal.load(cacheFile)
+        except (OSError, EOFError, ValueError, TypeError):
+            code = None
+
+    if code is None:
+        code = compile(generateProgramSource(programText.splitlines()), '<day08 program {0}>'.format(programHash[:12]), 'exec')
+
+        if cacheName is not None:
+            try:
+                os.makedirs(cacheDirectory, exist_ok=True)
+                (fileDescriptor, temporaryName) = tempfile.mkstemp(dir=cacheDirectory)
+                with os.fdopen(fileDescriptor, 'wb') as cacheFile:
+                    marshal.dump(code, cacheFile)
+                os.replace(temporaryName, cacheName)
+            except OSError:
+                pass
+
+    namespace = {}
+    exec(code, namespace) # pylint: disable=exec-used
+    function = namespace['runRegisterProgram']
+
+    COMPILED_PROGRAMS[programHash] = function
+
+    return function
+
+def doInstructionsCompiled(inputStringList, cacheDirectory=COMPILED_CACHE_DIRECTORY):
+    '''
+    Same as doInstructions, but compiles the program into a cached Python function
+    and runs that (see compileProgram).
+
+    '''
+
+    return compileProgram(inputStringList, cacheDirectory)()
+
 # Unit tests
 
 class TestDoInstructions(unittest.TestCase):
@@ -90,10 +262,54 @@ class TestDoInstructions(unittest.TestCase):
         self.assertEqual(result[0], TEST_RESULTS[0])
         self.assertEqual(result[1], TEST_RESULTS[1])
 
+    def test_fast(self):
+        '''
+        Tests the parsed program engine against doInstructions
+
+        '''
+
+        self.assertEqual(doInstructionsFast(TEST_INPUT.splitlines()), TEST_RESULTS)
+        self.assertEqual(doInstructionsFast(INPUT), doInstructions(INPUT))
+
+        # Registers that only ever go negative
+        program = ['a dec 5 if b == 0', 'b dec 2 if a < 0']
+        self.assertEqual(doInstructionsFast(program), doInstructions(program))
+
+        parsedProgram = parseProgram(TEST_INPUT.splitlines())
+        self.assertEqual(parsedProgram[0], ['b', 'a', 'c'])
+        self.assertEqual(runProgram(parsedProgram), TEST_RESULTS)
+
+        # A parsed program can be run again without anything left over from the last run
+        self.assertEqual(runProgram(parsedProgram), TEST_RESULTS)
+
+    def test_compiled(self):
+        '''
+        Tests compiled programs and their caches against doInstructions
+
+        '''
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(doInstructionsCompiled(TEST_INPUT.splitlines(), directory), TEST_RESULTS)
+            self.assertEqual(doInstructionsCompiled(INPUT, directory), doInstructions(INPUT))
+            self.assertEqual(len(os.listdir(directory)), 2)
+
+            # Cached in memory
+            self.assertIs(compileProgram(INPUT, directory), compileProgram(INPUT, directory))
+
+            # Cached on disk
+            COMPILED_PROGRAMS.clear()
+            self.assertEqual(doInstructionsCompiled(INPUT, directory), doInstructions(INPUT))
+            self.assertEqual(len(os.listdir(directory)), 2)
+
+        program = ['a dec 5 if b == 0', 'b dec 2 if a < 0']
+        self.assertEqual(doInstructionsCompiled(program, None), doInstructions(program))
+        self.assertRaises(KeyError, generateProgramSource, ['a inc 1 if b ~ 0'])
+        self.assertRaises(ValueError, generateProgramSource, ['a inc 1; if b == 0'])
+
 
 if __name__ == '__main__':
     print('Advent of Code\nDay 8: I Heard You Like Registers\n')
 
-    (maximum, absoluteMaximumEver) = doInstructions(INPUT)
+    (maximum, absoluteMaximumEver) = doInstructionsCompiled(INPUT)
     print('Part 1: The maximum value in a register is {0:d}'.format(maximum))
     print('Part 2: The maximum value, ever, in a register is {0:d}'.format(absoluteMaximumEver))